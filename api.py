@@ -2,26 +2,34 @@
 import os
 import re
 import sys
+import copy
 import json
-import pymongo
+import uuid
 import shopify
-from ftplib import FTP_TLS, FTP
-import urllib.request
 from urllib.error import HTTPError, URLError
 from pyactiveresource.connection import ResourceNotFound, ServerError, Error, BadRequest
 import pandas as pd
 from datetime import datetime
-from time import sleep
-from multiprocessing import Process, Manager, Lock, Queue, Value
+from concurrent.futures import ThreadPoolExecutor
 import shopify_limits
-from unidecode import unidecode
-from html import unescape
+import retry
+import query_cost
+from metrics import metrics, write_report
+from plan import Plan, Executor
+from feeds import FeedCache, QuantityIndex, INVENTORY_FILES, read_feed, compact
+from shards import shard_of
+from stale import StaleMappings
+from stores import Store
 from ssl import SSLEOFError
 from http.client import RemoteDisconnected
 from urllib.parse import urlparse
 import traceback
 
 
+class Stopped(Exception):
+    """Raised between batches when an inventory pass is asked to stop, i.e. because its shard lease was lost."""
+
+
 class API:
     """
     Class for handling and managing all API inventory items.
@@ -77,64 +85,168 @@ class API:
                      "Extended Colors 3", "Extended Colors 4", "Extended Colors 5", "Extended Colors 6",
                      "Extended Colors 7", "Extended Colors 8", "Extended Colors 9", "Extended Colors 10"]
     _image_url = "https://www.alphabroder.com/media/hires/{}".format
-    _product_file_sanmar = 'SanMar_EPDD.csv'
+    _product_file_sanmar = INVENTORY_FILES['sanmar'][0]
     _product_file = 'AllDBInfoALP_Prod.txt'
     _price_file = 'AllDBInfoALP_PRC_RZ19.txt'
-    _inventory_file = 'inventory-v8-alp.txt'
+    _inventory_file = INVENTORY_FILES['alpha'][0]
+    # Product file columns read for an import, and the subset the save workers need. Everything but item numbers and
+    # prices repeats across rows and is kept as a categorical.
+    _product_columns = ['Item Number', 'Style', 'Color Name', 'Size', 'Mill Name', 'Category', 'Front of Image Name',
+                        'Full Feature Description']
+    _product_columns_alpha = ['Short Description']
+    _product_columns_sanmar = ['PRODUCT_TITLE', 'MAP_PRICING']
+    _save_columns = ['Item Number', 'Style', 'Color Name', 'Size', 'Front of Image Name']
     _progress = []
     _save = False
     _sanmar = False
     _skip_existing = True
     # _categories = ['Polos', 'Outerwear', 'Fleece', 'Sweatshirts', 'Woven Shirts', 'T-Shirts', 'Infants | Toddlers']
 
-    def __init__(self, download=True, debug=False):
+    def __init__(self, download=True, debug=False, store=None):
         """Initialize inventory by parsing provided inventory CSV file and building a dict of all inventory items."""
+        self._store = store or Store()
         self._db = None
         self._download = download
         self._debug = debug
         self._current_products = {}
         self._product_images = {}
         self._styles_to_fix = []
-        self._categories = os.environ['CATEGORIES'].split(",")
-
-    def update_inventory(self, alpha_only=False):
-        """Update all product inventory values."""
-        if self._download:
-            self.debug("Downloading files.")
-            self.prepare_inventory(alpha_only)
+        self._categories = []
+        self._feeds = FeedCache('files', self.debug)
+        self._client = None
+        self._mapping_version = None
+        self._mapping_table = None
+        self._targets = {}
+        self._levels = {}
+        self._sold = {}
+        self._budget = None
+        self._levels_per_query = None
+        self._indexes = {}
+        self._indexes_version = None
+        self._snapshot = None
+        self._fingerprints = {}
+        self._removed = []
+        self._stale = None
+        self._product_cache = None
+        self._cost_drift = set()
+
+    @metrics.run('inventory')
+    def update_inventory(self, alpha_only=False, full=True, plan_path=None, shard=None, quantities=None, stop=None):
+        """Update all product inventory values, reported as one run (see `sync_inventory`)."""
+        return self.sync_inventory(alpha_only, full, plan_path, shard, quantities, stop)
+
+    def sync_inventory(self, alpha_only=False, full=True, plan_path=None, shard=None, quantities=None, stop=None):
+        """
+        Update all product inventory values.
+
+        With full=False only variants whose supplier quantity changed since the previous pass of this instance are
+        read from Shopify and adjusted. The first pass is always full. With plan_path the plan is written there
+        instead of being executed. With shard=(<Shard>, <Shard Count>) only the products of that shard are synced.
+        quantities from `prepare_inventory` can be passed in when several stores or shards share one feed load (see
+        stores.py and shards.py). Once the `stop` event is set the pass raises Stopped before its next batch.
+
+        Changes are applied lane by lane (see `inventory_lanes`), so stock-outs land before the bulk of the catalog.
+        """
+        if plan_path:
+            plan = self.plan_inventory(alpha_only, full, cached=True, shard=shard, quantities=quantities)
+            self.debug(f"Inventory plan: {plan.summary()}. Saved to {plan.save(plan_path)}.", True)
+            return plan
+
+        client, targets = self.inventory_changes(alpha_only, full, shard, quantities)
+        result = {'done': [], 'failed': []}
+        for lane, batch in self.inventory_lanes(targets):
+            self.check_stop(stop)
+            plan = self.plan_levels(client, self.group_targets(batch), Plan(f'inventory {lane}'), stop=stop)
+            self.check_stop(stop)
+            lane_result = Executor(self).run(plan)
+            failed = {step['variant_id'] for step in lane_result['failed']}
+            done = set(lane_result['done'])
+            for step in plan.of('inventory'):
+                if step['id'] in done:
+                    self._levels[step['variant_id']] = {'quantity': step['target'],
+                                                        'ii_id': step['inventory_item_id']}
+            for vid, target in plan.targets.items():
+                if vid not in failed:
+                    self._targets[vid] = target
+            result['done'].extend(lane_result['done'])
+            result['failed'].extend(lane_result['failed'])
+            self.debug(f"Lane '{lane}': {batch.shape[0]} variants, {len(done)} adjusted, {len(failed)} failed.", True)
+        # TODO: set to 0 products that weren't found
+        self.prune_mapping()
+        self._clean()
+        return result
+
+    @metrics.run('plan')
+    def execute_plan(self, path):
+        """Apply a saved plan, re-reading inventory first. Failed steps are saved as `<path>.failed.json` for replay."""
+        plan = Plan.load(path)
+        self.debug(f"Executing plan '{plan.name}' from {plan.created}: {plan.summary()}", True)
+        result = Executor(self, refresh=True).run(plan)
+        if result['failed']:
+            self.save_failed(plan, result['failed'], f'{os.path.splitext(path)[0]}.failed.json')
+        return result
+
+    def save_failed(self, plan, steps, path):
+        """Save failed steps of a plan to `path`, so they can be replayed with --execute. Return the path."""
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        failed = Plan(plan.name, [{key: value for key, value in step.items() if key != 'error'} for step in steps])
+        self.debug(f"Failed steps saved to {failed.save(path)}", True)
+        return path
+
+    def plan_inventory(self, alpha_only=False, full=True, cached=False, shard=None, quantities=None):
+        """
+        Compile the inventory adjustments needed to bring Shopify in line with the feeds.
+
+        Only reads are made, and variants missing in Shopify are not counted as stale. With cached=True inventory levels
+        remembered from earlier passes are used instead of reading them again, which makes planning nearly free in a
+        warm daemon.
+        """
+        client, targets = self.inventory_changes(alpha_only, full, shard, quantities)
+        return self.plan_levels(client, self.group_targets(targets), Plan('inventory'), cached, progress=True,
+                                record=False)
+
+    def inventory_changes(self, alpha_only=False, full=True, shard=None, quantities=None):
+        """Load the feeds, unless their quantities are given, and the mapping. Return the client and the targets."""
+        with metrics.phase('mongo load'):
+            self.load_mapping()
+
+        if quantities is None:
+            self.debug("Downloading and parsing inventory files." if self._download else "Parsing inventory files.")
+            with metrics.phase('feeds'):
+                quantities = self.prepare_inventory(alpha_only)
 
         self.debug("Connecting to shopify.")
-        shop_url = "https://{}:{}@{}.myshopify.com/admin/api/2020-07".format(os.environ["SHOPIFY_API_KEY"],
-                                                                             os.environ["SHOPIFY_PASSWORD"],
-                                                                             os.environ["SHOPIFY_STORE"])
-        shopify.ShopifyResource.set_site(shop_url)
-        shopify.ShopifyResource.headers.update({'X-Shopify-Access-Token': shopify.ShopifyResource.password})
-
-        if not self._db:
-            self._db = self.init_mongodb()
-
-        self._product_ids = self._sanitize_records(self._db.products.find())
-
-        # Parse Inventory File
-        self.debug("Parsing Inventory Files")
-        df_alpha = pd.read_csv(os.path.join('files', self._inventory_file), delimiter=',', engine='python', dtype='str')
-        df_sanmar = None
-        if not alpha_only:
-            df_sanmar = pd.read_csv(os.path.join('files', self._product_file_sanmar), delimiter=',', engine='python',
-                                    dtype='str')
-
-        # z = 0
-        # cursor = None
-        client = shopify.GraphQL()
-        inventory_item_adjustments = []
-
+        client = self.connect_shopify()
+
+        with metrics.phase('targets'):
+            targets = self.inventory_targets(quantities, alpha_only)
+            if shard is not None:
+                targets = targets[targets['pid'].map(lambda pid: shard_of(pid, shard[1])) == shard[0]]
+            if not full and self._targets:
+                targets = targets[targets['vid'].map(self._targets) != targets['target']]
+                self.debug(f"{targets.shape[0]} variants changed since the last pass.")
+        return client, targets
+
+    def plan_levels(self, client, targets, plan, cached=False, progress=False, record=True, stop=None):
+        """
+        Read the current levels of {<Product ID>: {<Variant ID>: <Target>}} and add the differences to a plan.
+
+        Variants are read together, as many per query as fit under the GraphQL cost ceiling (see query_cost.py), and
+        every level read is remembered for the lanes and cached plans. With record=False variants Shopify returns
+        nothing for are not counted towards pruning (see stale.py).
+        """
         product_progress = []
-        for i, pid in enumerate(self._product_ids):
-            p = int((i + 1) * 100 / len(self._product_ids))
-            if p not in product_progress:
+        read = 0
+        for batch in query_cost.pack(targets.items(), self.levels_per_query):
+            self.check_stop(stop)
+            read += len(batch)
+            p = int(read * 100 / len(targets))
+            if progress and p not in product_progress:
                 product_progress.append(p)
                 if self._debug:
-                    self.debug(f'{i}/{len(self._product_ids)} - {p}%')
+                    self.debug(f'{read}/{len(targets)} - {p}%')
                 else:
                     self.debug(f'{p}%', True)
 
@@ -142,24 +254,174 @@ class API:
             if os.environ.get('ONLY_THESE') is not None:
                 pass
 
-            joiner = '", "gid://shopify/ProductVariant/'
-            query = f'''
-                {{
-                    nodes(ids: ["gid://shopify/ProductVariant/{joiner.join(self._product_ids[pid].keys())}"]) {{
-                        ... on ProductVariant {{
-                            id
-                            inventoryQuantity
-                            inventoryItem {{
-                                id
-                            }}
-                        }}
-                    }}
-                }}
-            '''
+            variants = {vid: target for _, product in batch for vid, target in product.items()}
+            if cached and all(vid in self._levels for vid in variants):
+                levels = self._levels
+            else:
+                with metrics.phase('graphql reads'):
+                    levels = self.inventory_levels(client, list(variants))
+                # Variants Shopify returns nothing for were deleted there, or their product was.
+                if record:
+                    self.stale.record({vid: pid for pid, product in batch for vid in product if vid not in levels},
+                                      levels)
+                now = datetime.now()
+                for vid, level in levels.items():
+                    # Stock that went down since it was last seen here has been sold in Shopify.
+                    if vid in self._levels and level['quantity'] < self._levels[vid]['quantity']:
+                        self._sold[vid] = now
+                    self._levels[vid] = level
+            for vid, target in variants.items():
+                if vid in levels:
+                    if target != levels[vid]['quantity']:
+                        plan.add('inventory', variant_id=vid, inventory_item_id=levels[vid]['ii_id'],
+                                 available=levels[vid]['quantity'], target=target)
+                    plan.targets[vid] = target
+        return plan
 
-            cursor = None
-            data = self.execute_graphql(client, query)
-            ii_ids = {}
+    @staticmethod
+    def check_stop(stop):
+        """Raise Stopped if the given event is set."""
+        if stop is not None and stop.is_set():
+            raise Stopped("Inventory pass stopped.")
+
+    def prune_mapping(self):
+        """
+        Remove the variants confirmed as deleted in Shopify (see stale.py) from the mapping in one update.
+
+        Products left without variants are removed as a whole. The stored mapping is only changed if it is still the
+        version this pass loaded, so a product import that replaced it in the meantime wins. The prune gives the mapping
+        a new `_version`, so other processes reload it (see `load_mapping`). The pruned IDs are written to a report next
+        to the run reports.
+        """
+        stale = self.stale.confirmed()
+        if not stale:
+            return {}
+        unset = {}
+        pruned = {'variants': {}, 'products': []}
+        for pid, vids in stale.items():
+            variants = self._product_ids.get(pid, {})
+            gone = [vid for vid in vids if vid in variants]
+            if gone and len(gone) == len(variants):
+                unset[pid] = ''
+                pruned['products'].append(pid)
+            else:
+                unset.update({f'{pid}.{vid}': '' for vid in gone})
+            if gone:
+                pruned['variants'][pid] = gone
+        if unset:
+            mapping_id, version = self._mapping_version
+            pruned_version = uuid.uuid4().hex
+            result = self._db.products.update_one({'_id': mapping_id, '_version': version},
+                                                  {'$unset': unset, '$set': {'_version': pruned_version}})
+            if result.matched_count != 1:
+                self.debug("Mapping changed during the pass. Stale variants will be pruned next pass.", True)
+                return {}
+            self._mapping_version = (mapping_id, pruned_version)
+            for pid, vids in pruned['variants'].items():
+                for vid in vids:
+                    self._product_ids[pid].pop(vid, None)
+                    self._targets.pop(vid, None)
+                    self._levels.pop(vid, None)
+                if not self._product_ids[pid]:
+                    del self._product_ids[pid]
+            self._mapping_table = None
+        self.stale.forget(vid for vids in stale.values() for vid in vids)
+        count = sum(len(vids) for vids in pruned['variants'].values())
+        metrics.count('pruned variants', count)
+        path = write_report(pruned, f'pruned-{self._store.name}' if self._store.name else 'pruned')
+        self.debug(f"Pruned {count} stale variants and {len(pruned['products'])} products from the mapping"
+                   f"{f'. Report: {path}' if path else ''}.", True)
+        return pruned
+
+    def inventory_lanes(self, targets):
+        """
+        Split the targets into priority lanes and yield (<Lane>, <Targets>) in the order they should be applied.
+
+        zero  - the variant goes in or out of stock, or has nothing in stock and was not seen before
+        large - the quantity changes by at least PRIORITY_CHANGE (default 0.5) of the last known quantity
+        sold  - the variant sold in Shopify within the last PRIORITY_SOLD_WINDOW seconds (default 21600)
+        bulk  - everything else, in batches of PRIORITY_FLUSH_VARIANTS variants (default 5000)
+
+        The last known quantity is the level read from Shopify, or else the previous target. Without either (i.e. in a
+        one-shot run) a change can't be measured, so unseen variants with nothing in stock take the zero lane to get
+        possible stock-outs out first, and the others go to the bulk lane. Lanes are assigned per variant, since levels
+        are read by variant ID. Every lane is planned and applied before the next one is read, so the higher lanes use
+        the API budget first.
+        """
+        change = float(os.environ.get('PRIORITY_CHANGE', 0.5))
+        window = float(os.environ.get('PRIORITY_SOLD_WINDOW', 21600))
+        flush = int(os.environ.get('PRIORITY_FLUSH_VARIANTS', 5000))
+
+        now = datetime.now()
+        self._sold = {vid: at for vid, at in self._sold.items() if (now - at).total_seconds() < window}
+        levels = {vid: level['quantity'] for vid, level in self._levels.items()}
+        known = targets['vid'].map(levels).fillna(targets['vid'].map(self._targets))
+        target = targets['target']
+
+        zero = (known.notna() & ((target <= 0) != (known <= 0))) | (known.isna() & (target <= 0))
+        large = known.notna() & ((target - known).abs() >= change * known.abs().clip(lower=1))
+        sold = targets['vid'].isin(self._sold.keys())
+        lane = pd.Series(3, index=targets.index)
+        lane[sold] = 2
+        lane[large] = 1
+        lane[zero] = 0
+        for i, name in enumerate(('zero', 'large', 'sold')):
+            if (lane == i).any():
+                yield name, targets[lane == i]
+
+        bulk = targets[lane == 3]
+        for start in range(0, bulk.shape[0], max(flush, 1)):
+            yield 'bulk', bulk.iloc[start:start + max(flush, 1)]
+
+    def inventory_targets(self, quantities, alpha_only=False):
+        """
+        Calculate the inventory every mapped variant should have, for the whole catalog at once.
+
+        The mapping table is joined against each supplier's quantities (AlphaBroder already net of DROP SHIP) and the
+        results are added up. A variant whose items are not found in any feed is no longer tracked and gets 0.
+
+        targets = DataFrame[pid, vid, target]
+        """
+        table = self.mapping_table()
+        total = table['alpha'].map(quantities['alpha']).fillna(0)
+        if not alpha_only:
+            total += table['sanmar'].map(quantities['sanmar']).fillna(0)
+        return table[['pid', 'vid']].assign(target=total.astype('int64'))
+
+    @staticmethod
+    def group_targets(targets):
+        """Turn a targets table into {<Product ID>: {<Variant ID>: <Quantity>}}."""
+        grouped = {}
+        for pid, vid, target in zip(targets['pid'], targets['vid'], targets['target'].tolist()):
+            grouped.setdefault(pid, {})[vid] = target
+        return grouped
+
+    def mapping_table(self):
+        """
+        Flatten the mapping into one row per variant. Built once per mapping version.
+
+        table = DataFrame[pid, vid, alpha: <Item Number or None>, sanmar: <UNIQUE_KEY or None>]
+        """
+        if self._mapping_table is None:
+            rows = []
+            for pid, variants in self._product_ids.items():
+                for vid, item in variants.items():
+                    if isinstance(item, dict):
+                        rows.append((pid, vid, item.get('alpha'), item.get('sanmar')))
+                    else:
+                        rows.append((pid, vid, item, item))
+            self._mapping_table = pd.DataFrame(rows, columns=['pid', 'vid', 'alpha', 'sanmar'])
+        return self._mapping_table
+
+    def inventory_levels(self, client, vids):
+        """
+        Read current inventory of the given variants. Return {<Variant ID>: {"quantity": ..., "ii_id": ...}}.
+
+        The variants are split over as many queries as the GraphQL cost ceiling requires.
+        """
+        levels = {}
+        for batch in self.chunks(list(vids), self.levels_per_query):
+            data = self.execute_graphql(client, self.levels_query(batch))
             for item in data.get('data', {}).get('nodes', []):
                 if item:
                     vid = item['id'].replace('gid://shopify/ProductVariant/', '')
@@ -168,117 +430,51 @@ class API:
                         'ii_id': item.get('inventoryItem', {}).get('id')
                     }
                     if ii_data['ii_id'] is not None:
-                        ii_ids[vid] = ii_data
-
-            for vid, item in self._product_ids[pid].items():
-                if vid in ii_ids:
-                    alpha_item = item.get('alpha', None) if isinstance(item, dict) else item
-                    sanmar_item = item.get('sanmar', None) if isinstance(item, dict) else item
-
-                    found = False
-                    total = 0
-                    if alpha_item:
-                        alpha_row = df_alpha.loc[df_alpha['Item Number'].isin([alpha_item])]
-                        if not alpha_row.empty:
-                            found = True
-                            total += int(alpha_row[k("Total Inventory", False)].values[0])
-                            total -= int(alpha_row["DROP SHIP"].values[0])
-
-                    if sanmar_item and not alpha_only:
-                        sanmar_row = df_sanmar.loc[df_sanmar[k('Item Number', True)].isin([sanmar_item])]
-                        if not sanmar_row.empty:
-                            found = True
-                            total += int(sanmar_row[k("Total Inventory", True)].values[0])
-
-                    available_delta = -ii_ids[vid]['quantity']  # Set to 0 if inventory is no longer tracked
-                    if found:
-                        available_delta = total - ii_ids[vid]['quantity']  # Set to inventory
-
-                    if available_delta != 0:
-                        iia = f'{{inventoryItemId: "{ii_ids[vid]["ii_id"]}", availableDelta: {available_delta}}}'
-                        inventory_item_adjustments.append(iia)
-                        if len(inventory_item_adjustments) == 100:
-                            self.update_inventory_items(client, inventory_item_adjustments)
-                            inventory_item_adjustments = []
-
-        # while True:
-        #     self.debug("Getting page {}".format(z))
-        #
-        #     after = f', after: "{cursor}"' if cursor else ''
-        #     style = ''
-        #     if os.environ.get('ONLY_THESE') is not None:
-        #         style = " OR ".join(os.environ['ONLY_THESE'].split(","))
-        #         style = f', query: "{style}"'
-        #     query = f'''
-        #     {{
-        #       productVariants(first: 250{after}{style}) {{
-        #         edges {{
-        #           cursor
-        #           node {{
-        #             legacyResourceId
-        #             product {{
-        #               legacyResourceId
-        #             }}
-        #             inventoryQuantity
-        #             inventoryItem {{
-        #               id
-        #             }}
-        #           }}
-        #         }}
-        #       }}
-        #     }}
-        #     '''
-        #
-        #     cursor = None
-        #     data = self.execute_graphql(client, query)
-        #     for pv in data['data']['productVariants']['edges']:
-        #         node = pv['node']
-        #         cursor = pv['cursor']
-        #         pid = node['product']['legacyResourceId']
-        #         vid = node['legacyResourceId']
-        #         quantity = node['inventoryQuantity']
-        #         ii_id = node['inventoryItem']['id']
-        #
-        #         if pid in self._product_ids and vid in self._product_ids[pid]:
-        #             item = self._product_ids[pid][vid]
-        #             alpha_item = item.get('alpha', None) if isinstance(item, dict) else item
-        #             sanmar_item = item.get('sanmar', None) if isinstance(item, dict) else item
-        #
-        #             found = False
-        #             total = 0
-        #             if alpha_item:
-        #                 alpha_row = df_alpha.loc[df_alpha['Item Number'].isin([alpha_item])]
-        #                 if not alpha_row.empty:
-        #                     found = True
-        #                     total += int(alpha_row[k("Total Inventory", False)].values[0])
-        #                     total -= int(alpha_row["DROP SHIP"].values[0])
-        #
-        #             if sanmar_item and not alpha_only:
-        #                 sanmar_row = df_sanmar.loc[df_sanmar[k('Item Number', True)].isin([sanmar_item])]
-        #                 if not sanmar_row.empty:
-        #                     found = True
-        #                     total += int(sanmar_row[k("Total Inventory", True)].values[0])
-        #
-        #             # available_delta = -quantity  # Set to 0 if inventory is no longer tracked for this item
-        #             if found:
-        #                 available_delta = total - quantity  # Set to inventory
-        #
-        #                 iia = f'{{inventoryItemId: "{ii_id}", availableDelta: {available_delta}}}'
-        #                 inventory_item_adjustments.append(iia)
-        #                 if len(inventory_item_adjustments) == 100:
-        #                     self.update_inventory_items(client, inventory_item_adjustments)
-        #                     inventory_item_adjustments = []
-        #         # else:
-        #         #     self.debug(f"https://bulkthreads.myshopify.com/admin/products/{pid}/variants/{vid}")
-        #
-        #     z += 1
-        #
-        #     if cursor is None:
-        #         break
-
-        self.update_inventory_items(client, inventory_item_adjustments)
-        # TODO: set to 0 products that weren't found
-        self._clean()
+                        levels[vid] = ii_data
+        return levels
+
+    @staticmethod
+    def levels_query(vids):
+        """Query for the inventory of the given variants."""
+        joiner = '", "gid://shopify/ProductVariant/'
+        return f'''
+            {{
+                nodes(ids: ["gid://shopify/ProductVariant/{joiner.join(vids)}"]) {{
+                    ... on ProductVariant {{
+                        id
+                        inventoryQuantity
+                        inventoryItem {{
+                            id
+                        }}
+                    }}
+                }}
+            }}
+        '''
+
+    def connect_shopify(self):
+        """Point the Shopify resources at the store once and return a reusable GraphQL client."""
+        if self._client is None:
+            # Shopify resources are thread-local, so stores synced in parallel threads each get their own site.
+            shopify.ShopifyResource.set_site(self._store.url)
+            shopify.ShopifyResource.headers.update({'X-Shopify-Access-Token': shopify.ShopifyResource.password})
+            self._client = shopify.GraphQL()
+        return self._client
+
+    def load_mapping(self):
+        """Load the product/variant mapping from MongoDB, unless the stored document is the one already loaded."""
+        if not self._db:
+            self._db = self.init_mongodb()
+
+        # The mapping is replaced as a whole whenever products are imported, so its _id identifies its version. A prune
+        # changes it in place and sets a new _version instead (see `prune_mapping`).
+        current = self._db.products.find_one({}, {'_id': 1, '_version': 1})
+        version = (current['_id'], current.get('_version')) if current else None
+        if version is None or version != self._mapping_version:
+            self._product_ids = self._sanitize_records(self._db.products.find())
+            self._mapping_version = version
+            self._mapping_table = None
+            self._targets = {}
+        return self._product_ids
 
     @staticmethod
     def save_thread(products, is_last):
@@ -286,14 +482,10 @@ class API:
         import shopify
         import shopify_limits
 
-        shop_url = "https://{}:{}@{}.myshopify.com/admin/api/2020-07".format(os.environ["SHOPIFY_API_KEY"],
-                                                                             os.environ["SHOPIFY_PASSWORD"],
-                                                                             os.environ["SHOPIFY_STORE"])
-
         total = len(products)
         progress = []
         for i, product in enumerate(products):
-            save(product, 40)
+            save(product)
 
             p = int(100 * i / total)
             if is_last and p % 5 == 0 and p not in progress:
@@ -302,120 +494,285 @@ class API:
         if is_last:
             print("<{}>: 100%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
-    def update_products(self, limit=0, sanmar=False, skip_existing=True):
-        """Update all products."""
+    @metrics.run('products')
+    def update_products(self, limit=0, sanmar=False, skip_existing=True, resume=False, plan_path=None, changed=False):
+        """
+        Update all products.
+
+        Every style is checkpointed as soon as it has been saved. With resume=True the styles finished by a previous,
+        interrupted run are skipped and their IDs restored from the checkpoint.
+
+        With changed=True only styles whose feed rows were added, changed or removed since the last such import are
+        processed, existing items included (see snapshot.py). The first run without a snapshot processes everything.
+
+        Option fixes, price updates and metafields found while matching are compiled into a plan and executed before
+        the new products are saved. Failed steps are saved to `plans/products-<alpha|sanmar>.failed.json` for replay,
+        and the styles they belong to are not checkpointed, so --resume plans them again. With plan_path the plan is
+        written there and nothing is saved: the checkpoint and the product cache are left as they are.
+        """
+        from checkpoint import Checkpoint
+        from snapshot import Snapshot
+        from product_cache import ProductCache
+
+        self._plan = Plan('products')
         self._sanmar = sanmar
-        if self._sanmar:
-            self._categories = os.environ['CATEGORIES_SANMAR'].split(",")
-        self._skip_existing = skip_existing
+        self._categories = os.environ['CATEGORIES_SANMAR' if self._sanmar else 'CATEGORIES'].split(",")
+        self._skip_existing = skip_existing and not changed
+        self._checkpoint = Checkpoint(f"products-{'sanmar' if self._sanmar else 'alpha'}")
+        self._snapshot = Snapshot(f"products-{'sanmar' if self._sanmar else 'alpha'}") if changed else None
+        if not resume and not plan_path:
+            self._checkpoint.clear()
 
         if self._download:
             self.debug("Downloading files.")
-            self.prepare_products()
+            with metrics.phase('feeds'):
+                self.prepare_products()
 
         self.debug("Connecting to shopify.")
-        shop_url = "https://{}:{}@{}.myshopify.com/admin/api/2020-07".format(os.environ["SHOPIFY_API_KEY"],
-                                                                             os.environ["SHOPIFY_PASSWORD"],
-                                                                             os.environ["SHOPIFY_STORE"])
-        shopify.ShopifyResource.set_site(shop_url)
-        shopify.ShopifyResource.headers.update({'X-Shopify-Access-Token': shopify.ShopifyResource.password})
+        client = self.connect_shopify()
 
         self.debug("Retrieving database entries.")
         # changes = self.find_changes()
 
         if not self._db:
             self._db = self.init_mongodb()
+        self._product_cache = ProductCache(self._db, write=not plan_path)
 
-        inventory_store = self._sanitize_records(self._db.inventory.find())
-        self._product_ids = self._sanitize_records(self._db.products.find())
+        with metrics.phase('mongo load'):
+            inventory_store = self._sanitize_records(self._db.inventory.find())
+            self._product_ids = self._sanitize_records(self._db.products.find())
 
         # Parse Product File
         self.debug("Parsing Product File")
 
-        self._load_product_file(inventory_store, limit)
+        with metrics.phase('parse'):
+            self._load_product_file(inventory_store, limit)
+
+        if resume:
+            self.restore_checkpoint()
 
         self.debug("Processing products.")
-        total = self._inventory.shape[0]
-        client = shopify.GraphQL()
-        progress = []
-        for i, (index, item) in enumerate(self._inventory.iterrows()):
-            if 'Drop Ship' in item[self.k("Mill Name")]:
-                continue
-            if item[self.k("Style")] not in self._current_products:
-                products = []
-                z = 0
-                cursor = None
-
-                while True:
-                    after = f', after: "{cursor}"' if cursor else ''
-                    style = f', query: "{item[self.k("Style")]}"'
-                    query = f'''
-                            {{
-                              products(first: 250{after}{style}) {{
-                                edges {{
-                                  cursor
-                                  node {{
-                                    legacyResourceId
-                                  }}
-                                }}
-                              }}
-                            }}
-                            '''
-
-                    cursor = None
-                    data = self.execute_graphql(client, query)
-                    for pv in data['data']['products']['edges']:
-                        node = pv['node']
-                        cursor = pv['cursor']
-                        pid = node['legacyResourceId']
-                        product = shopify.Product.find(pid)
-                        if product and item[self.k("Style")] in product.title:
-                            style = product.title.replace(',', '').replace(':', '').split(' ')
-                            if item[self.k("Style")] in style:
-                                if len(product.options) > 0 and product.options[0].name == 'Color':
-                                    for x in range(len(product.variants)):
-                                        product.variants[x].option2, product.variants[x].option1 = (
-                                            product.variants[x].option1, product.variants[x].option2
-                                        )
-                                    product.options.reverse()
-                                    product.save()
-                                    # print("----{} needs checked.----".format(item[self.k("Style")]))
-                                    self._styles_to_fix.append(item[self.k("Style")])
-                                if len(product.variants) == 1 and product.variants[0].title == 'Default Title':
-                                    product.variants = []
-                                products.append(product)
-                    z += 1
-
-                    if cursor is None:
-                        break
-                self._current_products[item[self.k("Style")]] = products
-            of_color = self._inventory.loc[(self._inventory[self.k("Style")] == item[self.k("Style")])
-                                           & (self._inventory[self.k("Color Name")] == item[self.k("Color Name")])
-                                           ].shape[0]
-            self.process_item(item, of_color)
-            p = int(100 * i / total)
-            if p % 10 == 0 and p not in progress:
-                self.debug("{}%".format(p))
-                progress.append(p)
-        self.debug("100%\n")
+        with metrics.phase('matching'):
+            self.match_products(client)
+
+        self.debug("Setting metafields.")
+        with metrics.phase('metafields'):
+            self.set_metafields()
+
+        if plan_path:
+            self.debug(f"Product plan: {self._plan.summary()}. Saved to {self._plan.save(plan_path)}.", True)
+            return self._plan
+
+        self.debug("Applying plan.")
+        with metrics.phase('plan'):
+            result = Executor(self).run(self._plan)
+        unfinished = set()
+        if result['failed']:
+            self.save_failed(self._plan, result['failed'],
+                             os.path.join('plans', f"products-{'sanmar' if self._sanmar else 'alpha'}.failed.json"))
+            unfinished = self.failed_styles(result['failed'])
 
         self.debug("Saving new products.")
-        self.start_save_processes()
+        self.start_save_processes(unfinished)
+        if result['failed']:
+            self._save = False
 
         if self._save:
             self.debug("Updating Database.")
-            for key, item in inventory_store.items():
-                self._shopify_ids[str(key)] = item
-            self._db.inventory.delete_many({})
-            self._db.inventory.insert_one(self._shopify_ids)
-            self._db.products.delete_many({})
-            self._db.products.insert_one(self._product_ids)
+            with metrics.phase('mongo save'):
+                for key, item in inventory_store.items():
+                    self._shopify_ids[str(key)] = item
+                self._db.inventory.delete_many({})
+                self._db.inventory.insert_one(self._shopify_ids)
+                self._db.products.delete_many({})
+                self._db.products.insert_one(self._product_ids)
+            self._checkpoint.clear()
+            if self._snapshot:
+                self._snapshot.save(self._fingerprints, self._removed)
         else:
-            self.debug("Errors found. Skipping save.")
+            # Whatever was created is still recorded so the next run does not have to rediscover it.
+            self.debug("Errors found. Saving finished styles only. Re-run with --resume to continue.", True)
+            with metrics.phase('mongo save'):
+                for key, item in inventory_store.items():
+                    self._shopify_ids.setdefault(str(key), item)
+                self._db.inventory.delete_many({})
+                self._db.inventory.insert_one(self._shopify_ids)
+                self._db.products.delete_many({})
+                self._db.products.insert_one(self._product_ids)
         self._clean()
 
         print(", ".join(self._styles_to_fix))
 
+    def failed_styles(self, steps):
+        """Return the styles whose products or variants the given plan steps belong to."""
+        pids = {str(step['product_id']) for step in steps if step.get('product_id')}
+        vids = {str(step['variant_id']) for step in steps if step.get('variant_id')}
+        return {style for style, products in self._current_products.items()
+                if any(str(p.id) in pids or any(str(v.id) in vids for v in p.variants) for p in products)}
+
+    def restore_checkpoint(self):
+        """Skip the styles finished by an interrupted run and restore the IDs recorded for them."""
+        finished = self._checkpoint.load()
+        if not finished:
+            return
+        sa = 'sanmar' if self._sanmar else 'alpha'
+        for style, ids in finished.items():
+            for key, item in ids.items():
+                self._shopify_ids[key] = item
+                self._product_ids.setdefault(str(item["product_id"]), {}).setdefault(str(item["variant_id"]), {})[sa] = key
+        self._inventory = self._inventory.loc[~self._inventory[self.k('Style')].isin(finished.keys())]
+        self.debug(f"Resuming: {len(finished)} styles already finished, {self._inventory.shape[0]} items left.", True)
+
+    def match_products(self, client):
+        """
+        Find the Shopify products of every style in the product file and match each item to its variant.
+
+        Styles are independent, so they are matched by a pool of MATCH_WORKERS threads (default 4) sharing the GraphQL
+        client, rate limiting and cost budget. Each style is matched into its own results (see `match_style`), which
+        are merged in feed order so the outcome does not depend on which thread finished first. Every style is matched
+        in the caller's phase, so its requests and profile are reported there.
+        """
+        styles = list(self._inventory.groupby(self.k("Style"), sort=False, observed=True))
+        total = len(styles)
+        progress = []
+        workers = int(os.environ.get('MATCH_WORKERS', 4))
+        phase = metrics.current()
+
+        def task(style):
+            with metrics.phase(phase):
+                return self.match_style(client, *style)
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for i, match in enumerate(pool.map(task, styles)):
+                self.merge_match(match)
+                p = int(100 * i / total)
+                if p % 10 == 0 and p not in progress:
+                    self.debug("{}%".format(p))
+                    progress.append(p)
+        self.debug("100%\n")
+
+    def match_style(self, client, style, items):
+        """Match the items of one style on a copy of the API whose results start empty. Return the copy."""
+        match = copy.copy(self)
+        match._current_products = {}
+        match._shopify_ids = {}
+        match._product_ids = {}
+        match._images = {}
+        match._styles_to_fix = []
+        match._plan = Plan(self._plan.name)
+        for index, item in items.iterrows():
+            if 'Drop Ship' in item[self.k("Mill Name")]:
+                continue
+            if style not in match._current_products:
+                match._current_products[style] = match.find_style_products(client, style)
+            of_color = items.loc[items[self.k("Color Name")] == item[self.k("Color Name")]].shape[0]
+            match.process_item(item, of_color)
+        return match
+
+    def merge_match(self, match):
+        """Add the results of `match_style` to this instance."""
+        self._current_products.update(match._current_products)
+        self._shopify_ids.update(match._shopify_ids)
+        for pid, variants in match._product_ids.items():
+            for vid, items in variants.items():
+                self._product_ids.setdefault(pid, {}).setdefault(vid, {}).update(items)
+        self._images.update(match._images)
+        self._styles_to_fix.extend(match._styles_to_fix)
+        for step in match._plan.steps:
+            self._plan.add(step['op'], **{key: value for key, value in step.items() if key not in ('id', 'op')})
+
+    def find_style_products(self, client, style_name):
+        """
+        Search Shopify for the products of a style, putting Size before Color in their options.
+
+        Products whose updatedAt matches the product cache are taken from it (see product_cache.py). The rest are
+        fetched and cached as read, before any changes are made to them here.
+        """
+        products = []
+        z = 0
+        cursor = None
+
+        while True:
+            query = self.products_query(style_name, self.products_per_query, cursor)
+            cursor = None
+            data = self.execute_graphql(client, query)
+            edges = data['data']['products']['edges']
+            cached = self.product_cache.get({pv['node']['legacyResourceId']: pv['node'].get('updatedAt')
+                                              for pv in edges})
+            for pv in edges:
+                node = pv['node']
+                cursor = pv['cursor']
+                pid = node['legacyResourceId']
+                product = cached.get(pid)
+                if product is None:
+                    product = retry.call(lambda: shopify.Product.find(pid))
+                    if product:
+                        self.product_cache.put(product)
+                if product and style_name in product.title:
+                    style = product.title.replace(',', '').replace(':', '').split(' ')
+                    if style_name in style:
+                        if len(product.options) > 0 and product.options[0].name == 'Color':
+                            for x in range(len(product.variants)):
+                                product.variants[x].option2, product.variants[x].option1 = (
+                                    product.variants[x].option1, product.variants[x].option2
+                                )
+                            product.options.reverse()
+                            self._plan.add('product_options', product_id=str(product.id))
+                            # print("----{} needs checked.----".format(style_name))
+                            self._styles_to_fix.append(style_name)
+                        if len(product.variants) == 1 and product.variants[0].title == 'Default Title':
+                            product.variants = []
+                        products.append(product)
+            z += 1
+
+            if cursor is None:
+                break
+        return products
+
+    def products_updated(self, client, pids):
+        """Read the current updatedAt of the given products. Return {<Product ID>: <updatedAt>}."""
+        updated = {}
+        for batch in self.chunks(list(pids), query_cost.MAX_IDS):
+            data = self.execute_graphql(client, self.updated_query(batch))
+            for node in data.get('data', {}).get('nodes', []):
+                if node:
+                    updated[node['legacyResourceId']] = node['updatedAt']
+        return updated
+
+    @staticmethod
+    def updated_query(pids):
+        """Query for the updatedAt of the given products."""
+        joiner = '", "gid://shopify/Product/'
+        return f'''
+            {{
+                nodes(ids: ["gid://shopify/Product/{joiner.join(pids)}"]) {{
+                    ... on Product {{
+                        legacyResourceId
+                        updatedAt
+                    }}
+                }}
+            }}
+        '''
+
+    @staticmethod
+    def products_query(style_name, first, cursor=None):
+        """Query for a page of the products matching a style."""
+        after = f', after: "{cursor}"' if cursor else ''
+        style = f', query: "{style_name}"'
+        return f'''
+                {{
+                  products(first: {first}{after}{style}) {{
+                    edges {{
+                      cursor
+                      node {{
+                        legacyResourceId
+                        updatedAt
+                      }}
+                    }}
+                  }}
+                }}
+                '''
+
     def process_item(self, item, of_color):
         """Check if item already exists. If not, create a new variant and add it."""
         skip = False
@@ -461,7 +818,7 @@ class API:
 
                             # Remove
                             variant.price = price
-                            variant.save()
+                            self._plan.add('price', variant_id=str(variant.id), price=price)
                             #
 
                             # if price != variant.price:
@@ -536,9 +893,14 @@ class API:
             if not found:
                 self._current_products[item[self.k("Style")]].append(product)
 
-    def start_save_processes(self):
-        """Create Processes that will save all the changes."""
-        self.debug("Setting metafields.")
+    def start_save_processes(self, unfinished=()):
+        """Create Processes that will save all the changes. The `unfinished` styles are saved but not checkpointed."""
+        self.debug("Starting processes.")
+        with metrics.phase('save'):
+            self.run_save_processes(unfinished)
+
+    def set_metafields(self):
+        """Plan the metafields linking the products of each style to each other. Only changed values are planned."""
         total = len(self._current_products.keys())
         progress = []
         for i, key in enumerate(self._current_products):
@@ -552,41 +914,30 @@ class API:
             if not main_product:
                 main_product = self._current_products[key][0].handle
             other_products = [product.handle for product in self._current_products[key] if product.handle != main_product]
-            for x in range(len(self._current_products[key])):
-                metafields = self._current_products[key][x].metafields()
-                mp = False
-                op = False
-                for mf in metafields:
-                    if mf.namespace == 'api_integration':
-                        if mf.key == 'main_product':
-                            mp = True
-                            mf.value = main_product
-                        elif mf.key == 'other_product':
-                            op = True
-                            if other_products:
-                                mf.value = other_products
-                        mf.save()
-
-                if not mp:
-                    self._current_products[key][x].add_metafield(shopify.Metafield({
-                        'key': 'main_product',
-                        'value': main_product,
-                        'value_type': 'string',
-                        'namespace': 'api_integration'
-                    }))
-                if not op and other_products:
-                    self._current_products[key][x].add_metafield(shopify.Metafield({
-                        'key': 'other_products',
-                        'value': ",".join(other_products),
-                        'value_type': 'string',
-                        'namespace': 'api_integration'
-                    }))
+            values = {'main_product': main_product, 'other_products': ",".join(other_products)}
+            for product in self._current_products[key]:
+                found = set()
+                for mf in retry.call(product.metafields):
+                    if mf.namespace == 'api_integration' and mf.key in ('main_product', 'other_product', 'other_products'):
+                        name = 'other_products' if mf.key != 'main_product' else mf.key
+                        found.add(name)
+                        if values[name] and mf.value != values[name]:
+                            self._plan.add('metafield', product_id=str(product.id), metafield_id=str(mf.id),
+                                           key=mf.key, value=values[name])
+
+                for name, value in values.items():
+                    if name not in found and value:
+                        self._plan.add('metafield', product_id=str(product.id), metafield_id=None, key=name,
+                                       value=value)
             p = int(100 * i / total)
             if p % 5 == 0 and p not in progress:
                 self.debug("{}%".format(p))
                 progress.append(p)
 
-        self.debug("Starting processes.")
+    def run_save_processes(self, unfinished=()):
+        """Save all products in NUM_THREADS processes and collect the resulting variant IDs."""
+        from multiprocessing import Process, Manager, Value
+
         processes = []
 
         manager = Manager()
@@ -595,14 +946,25 @@ class API:
         ns.progress = []
         ns.shopify_ids = self._shopify_ids
         shopify_ids = manager.dict()
+        reports = manager.list()
+        saved = manager.list()
         ns.skip_existing = self._skip_existing
-        ns.inventory = self._inventory
+        ns.inventory = self._inventory[[self.k(c) for c in self._save_columns]]
+        styles = dict(zip(self._inventory[self.k('Item Number')], self._inventory[self.k('Style')]))
+        matched = {}
+        for key, item in self._shopify_ids.items():
+            if key in styles:
+                matched.setdefault(styles[key], {})[key] = item
+        ns.matched = matched
+        ns.unfinished = set(unfinished)
         index = Value("i", 0)
         total = len(ns.products)
 
         r = int(os.environ["NUM_THREADS"]) if int(os.environ["NUM_THREADS"]) < total else total
         for i in range(r):
-            p = Process(target=self.save_new_products, args=(ns, index, shopify_ids, total, self._sanmar))
+            p = Process(target=self.save_new_products,
+                        args=(ns, index, shopify_ids, total, self._sanmar, reports, self.profile_folder,
+                              self._checkpoint, self._store, saved))
             p.daemon = True
             p.start()
             processes.append(p)
@@ -614,6 +976,13 @@ class API:
                 self._save = False
 
         self.debug("Processes completed.")
+        for report in reports:
+            metrics.merge(report)
+        # The workers hand back what they saved, so the cache is written here, to the database this run uses. Saving
+        # variants moved each product's updatedAt past what its save returned, so the current one is read back.
+        updated = self.products_updated(self.connect_shopify(), [str(product['id']) for product in saved])
+        for product in saved:
+            self.product_cache.put(dict(product, updated_at=updated.get(str(product['id']))))
         sa = 'sanmar' if self._sanmar else 'alpha'
         vids = []
         for key, item in shopify_ids.items():
@@ -631,7 +1000,7 @@ class API:
         query = f'''
           mutation {{
               inventoryBulkAdjustQuantityAtLocation(
-                locationId: "gid://shopify/Location/{os.environ['SHOPIFY_LOCATION']}",
+                locationId: "gid://shopify/Location/{self._store.location}",
                 inventoryItemAdjustments: [
                   {f',{nl}'.join(inventory_item_adjustments)}
                   ]) {{
@@ -639,47 +1008,96 @@ class API:
                 inventoryLevels {{
                   available
                 }}
+                userErrors {{
+                  field
+                  message
+                }}
               }}
             }}
         '''
 
-        self.execute_graphql(client, query)
+        with metrics.phase('mutations'):
+            return self.execute_graphql(client, query)
 
-    def execute_graphql(self, client, query, retries=0):
-        """Execute graphql query and wait if necessary."""
-        if retries > 4:
-            self.debug('Could not complete call. Max retries met.', True)
-        try:
-            result = client.execute(query)
-            result = json.loads(result)
-        except urllib.error.HTTPError as e:
-            self.debug('Caught: Internal Server Error. Retrying in 3 minutes.', True)
-            sleep(180)
-            retries += 1
-            return self.execute_graphql(client, query, retries)
-
-        # {'errors': [{'message': 'Throttled', 'extensions': {'code': 'THROTTLED',
-        #                                                     'documentation': 'https://help.shopify.com/api/graphql-admin-api/graphql-admin-api-rate-limits'}}],
-        #  'extensions': {'cost': {'requestedQueryCost': 752, 'actualQueryCost': None,
-        #                          'throttleStatus': {'maximumAvailable': 1000.0, 'currentlyAvailable': 744,
-        #                                             'restoreRate': 50.0}}}}
-
-        if 'errors' in result:
-            cost = result['extensions']['cost']
-            sleep_for = (cost['requestedQueryCost'] + 10 - cost['throttleStatus']['currentlyAvailable'])
-            sleep_for /= cost['throttleStatus']['restoreRate']
-            self.debug(f'Retrying GraphQL query in: {sleep_for}s')
-            sleep(sleep_for)
+    def execute_graphql(self, client, query):
+        """
+        Execute graphql query and wait if necessary.
 
-            return self.execute_graphql(client, query)
-        else:
-            return result
+        Failed requests are retried with backoff (see retry.py) and throttled queries once enough cost is restored.
+        The cost of the query is estimated locally (see query_cost.py), taken from the shared budget first when
+        workers share one, and checked against the cost Shopify reports.
+        """
+        def request():
+            metrics.count('graphql')
+            return json.loads(client.execute(query))
+
+        cost = query_cost.estimate(query)
+        while True:
+            if self._budget:
+                self._budget.take(cost)
+            result = retry.call(request)
+            metrics.graphql_cost(result)
+            if self._budget:
+                self._budget.observe(result)
+            self.check_cost(query, cost, result)
+
+            # {'errors': [{'message': 'Throttled', 'extensions': {'code': 'THROTTLED',
+            #                                                     'documentation': 'https://help.shopify.com/api/graphql-admin-api/graphql-admin-api-rate-limits'}}],
+            #  'extensions': {'cost': {'requestedQueryCost': 752, 'actualQueryCost': None,
+            #                          'throttleStatus': {'maximumAvailable': 1000.0, 'currentlyAvailable': 744,
+            #                                             'restoreRate': 50.0}}}}
+
+            if 'errors' not in result:
+                return result
+            if not any(e.get('extensions', {}).get('code') == 'THROTTLED' for e in result['errors']):
+                raise ValueError("; ".join(e.get('message', '') for e in result['errors']))
+            status = result['extensions']['cost']
+            sleep_for = (status['requestedQueryCost'] + 10 - status['throttleStatus']['currentlyAvailable'])
+            sleep_for /= status['throttleStatus']['restoreRate']
+            self.debug(f'Retrying GraphQL query in: {sleep_for}s')
+            metrics.sleep('throttle', sleep_for)
+
+    def check_cost(self, query, estimate, result):
+        """Log when Shopify's requested cost differs from the local estimate, once per query shape and cost."""
+        requested = (result or {}).get('extensions', {}).get('cost', {}).get('requestedQueryCost')
+        if requested is None or requested == estimate:
+            return
+        shape = (re.sub(r'\s+', ' ', query.strip())[:60], estimate, requested)
+        if shape not in self._cost_drift:
+            self._cost_drift.add(shape)
+            self.debug(f"GraphQL cost estimate {estimate} differs from Shopify's {requested} for: {shape[0]}...", True)
 
     @staticmethod
-    def save_new_products(ns, index, shopify_ids, total, sanmar):
+    def save_new_products(ns, index, shopify_ids, total, sanmar, reports=None, profile_folder=None, checkpoint=None,
+                          store=None, saved=None):
         """Loop through self._current_products and save the last in each list"""
         import shopify
         import shopify_limits
+        from profiling import Profiler
+
+        metrics.start('save')
+        metrics.profiler = Profiler(profile_folder) if profile_folder else None
+        with metrics.phase('save'):
+            failed = API._save_new_products(ns, index, shopify_ids, total, sanmar, checkpoint, store, saved)
+        if metrics.profiler:
+            metrics.profiler.dump(f'save-{os.getpid()}')
+        if reports is not None:
+            reports.append(metrics.report())
+        if failed:
+            # A non-zero exit keeps the checkpoint so --resume retries the failed styles.
+            sys.exit(1)
+
+    @staticmethod
+    def _save_new_products(ns, index, shopify_ids, total, sanmar, checkpoint=None, store=None, saved=None):
+        """
+        Save products claimed from the shared index until none are left, checkpointing each finished style. Every
+        product saved with all of its variants is appended to `saved` as a dict for the product cache.
+
+        Return the styles that could not be saved.
+        """
+        import urllib.request
+
+        store = store or Store()
 
         def find_image(filename, product_id, sanmar):
             """Check if image in self._images otherwise download and create it."""
@@ -687,7 +1105,8 @@ class API:
                 hires = filename.split(".")
                 hires[-2] = ''.join([hires[-2][:-1], 'z'])
                 hires = ".".join(hires)
-                url = "https://www.alphabroder.com/media/hires/{}".format(hires) if not sanmar else filename
+                image_url = os.environ.get('ALPHA_IMAGE_URL', 'https://www.alphabroder.com/media/hires/')
+                url = f"{image_url}{hires}" if not sanmar else filename
 
                 if sanmar:
                     a = urlparse(filename)
@@ -715,20 +1134,19 @@ class API:
             else:
                 return None
 
-        shop_url = "https://{}:{}@{}.myshopify.com/admin/api/2020-07".format(os.environ["SHOPIFY_API_KEY"],
-                                                                             os.environ["SHOPIFY_PASSWORD"],
-                                                                             os.environ["SHOPIFY_STORE"])
-        shopify.ShopifyResource.set_site(shop_url)
+        shopify.ShopifyResource.set_site(store.url)
+        matched = ns.matched if checkpoint else {}
+        unfinished = ns.unfinished if checkpoint else set()
 
-        current = 0
-        while True:
-            with index.get_lock():
-                current = index.value
-                index.value += 1
-            if current >= total:
-                break
+        def save_style(style, products):
+            """
+            Save the products of one style. Return False if anything could not be saved.
 
-            style, products = ns.products[current]
+            Raise retry.Transient if Shopify is failing for now. Only a style saved completely, without failed plan
+            steps, is checkpointed, so --resume retries the rest.
+            """
+            style_ids = dict(matched.get(style, {}))
+            complete = True
             for product in products:
                 color_option = ""
                 size_option = ""
@@ -748,9 +1166,11 @@ class API:
                     if v.attributes[color_option] not in colors:
                         colors.append(v.attributes[color_option])
                 product.options = [{"name": "Size", "values": sizes}, {"name": "Color", "values": colors}]
-                if not save(product):
+                if not save(product, defer=True):
+                    complete = False
                     continue
 
+                variants_saved = True
                 images = {}
                 for variant in product.variants:
                     color_name = str(variant.attributes[color_option]).upper()
@@ -772,15 +1192,59 @@ class API:
                         if image:
                             variant.image_id = image.id
                             if save(variant):
-                                shopify_ids[row[k("Item Number", sanmar)].values[0]] = {
+                                ids = {
                                     "variant_id": variant.id,
                                     "product_id": product.id
                                 }
+                                shopify_ids[row[k("Item Number", sanmar)].values[0]] = ids
+                                style_ids[str(row[k("Item Number", sanmar)].values[0])] = ids
+                            else:
+                                variants_saved = False
+                                complete = False
+                # Only a product whose saves all went through matches Shopify well enough to be cached.
+                if saved is not None and variants_saved:
+                    saved.append(product.to_dict())
+
+            if checkpoint and complete and style not in unfinished:
+                checkpoint.record(style, style_ids)
+            return complete
+
+        # Styles whose products failed transiently are parked and retried after the others, once their backoff passed.
+        deferred = retry.DeferredQueue()
+        failed = []
+        current = 0
+        while True:
+            with index.get_lock():
+                current = index.value
+                index.value += 1
+            attempt = 0
+            if current < total:
+                style, products = ns.products[current]
+            else:
+                parked = deferred.next()
+                if parked is None:
+                    break
+                (style, products), attempt = parked
 
-            p = int(100 * current / total)
-            if p not in ns.progress:
-                print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), p))
-                ns.progress.append(p)
+            try:
+                if not save_style(style, products):
+                    print(f"<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Could not save all of {style}.")
+                    failed.append(style)
+            except retry.Transient as e:
+                if deferred.park((style, products), e.kind, attempt):
+                    print(f"<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Deferred {style} ({e}).")
+                else:
+                    print(f"<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Could not save {style} ({e}).")
+                    failed.append(style)
+                continue
+
+            if current < total:
+                p = int(100 * current / total)
+                if p not in ns.progress:
+                    print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), p))
+                    ns.progress.append(p)
+
+        return failed
 
     def new_product(self, mill_name, style, short_description, full_description, category, color_index):
         """Create a new Shopify product with the given data."""
@@ -801,7 +1265,8 @@ class API:
             [li.strip() for li in desc_split]))
         new_product.vendor = mill_name
         new_product.product_type = category
-        new_product.save()
+        retry.call(new_product.save)
+        self.product_cache.put(new_product)
         new_product.variants = []
         return new_product
 
@@ -809,35 +1274,82 @@ class API:
         """Load in product files"""
         pf = self._product_file_sanmar if self._sanmar else self._product_file
         delimiter = ',' if self._sanmar else '^'
-        self._inventory = pd.read_csv(os.path.join('files', pf), delimiter=delimiter, engine='python', dtype='str')
-        if self._sanmar:
-            self._inventory = self._inventory.loc[self._inventory[self.k('Category')].isin(self._categories)]
-        else:
-            self._inventory = self._inventory.loc[self._inventory[self.k('Category')].isin(self._categories)]
-            self._inventory = self._inventory.loc[~self._inventory[self.k('Mill Name')].str.contains(
-                'Drop Ship', flags=re.IGNORECASE, regex=True)]
-
-        if self._skip_existing:
-            self._inventory = self._inventory.loc[~self._inventory[self.k('Item Number')].isin(inventory_store.keys())]
-        if os.environ.get('ONLY_THESE') is not None:
-            these = os.environ['ONLY_THESE'].split(",")
-            self._inventory = self._inventory.loc[self._inventory[self.k('Style')].isin(these)]
-
-        if self._sanmar and os.environ.get('BRANDS_SANMAR') is not None:
-            brands = os.environ.get('BRANDS_SANMAR').split(',')
-            self._inventory = self._inventory.loc[self._inventory[self.k('Mill Name')].isin(brands)]
-
-        self._inventory = self._inventory.replace({self.k("Mill Name"): {'Bella + Canvas': 'Bella+Canvas'}})
+        columns = [self.k(c) for c in self._product_columns]
+        columns += self._product_columns_sanmar if self._sanmar else self._product_columns_alpha
+        values = (self.k('Item Number'), 'MAP_PRICING')
+        self._inventory = read_feed(os.path.join('files', pf), columns, [c for c in columns if c not in values],
+                                    delimiter, select=self.product_rows(inventory_store))
+
+        mill = self.k("Mill Name")
+        mills = self._inventory[mill].astype(object).replace({'Bella + Canvas': 'Bella+Canvas'})
+        self._inventory = compact(self._inventory.assign(**{mill: mills.astype('category')}))
+        if self._snapshot:
+            self._inventory = self.changed_styles(self._inventory)
 
         self._inventory.sort_values(self.k('Style'))
 
         self.debug(f"Found: {self._inventory.shape[0]}")
         if limit > 0:
             self._inventory = self._inventory.head(limit)
+        if self._snapshot:
+            # Only the rows imported now are recorded. The rest of their styles is still pending next time.
+            imported = set(self._inventory[self.k('Item Number')].astype(str))
+            self._fingerprints = {item: entry for item, entry in self._fingerprints.items() if item in imported}
         self.debug(f"Importing: {self._inventory.shape[0]}")
 
+    def product_rows(self, inventory_store):
+        """
+        Return select(<Chunk>) for read_feed, keeping the product file rows this import uses.
+
+        Rows are filtered by category (and Drop Ship mills for AlphaBroder), existing items if skipped, ONLY_THESE and
+        BRANDS_SANMAR while the file is read, so rows outside the selection are never held in memory.
+        """
+        existing = set(inventory_store.keys()) if self._skip_existing else None
+        these = os.environ['ONLY_THESE'].split(",") if os.environ.get('ONLY_THESE') is not None else None
+        brands = None
+        if self._sanmar and os.environ.get('BRANDS_SANMAR') is not None:
+            brands = os.environ.get('BRANDS_SANMAR').split(',')
+
+        def select(chunk):
+            rows = chunk[self.k('Category')].isin(self._categories)
+            if not self._sanmar:
+                rows &= ~chunk[self.k('Mill Name')].str.contains('Drop Ship', flags=re.IGNORECASE, regex=True, na=False)
+            if existing is not None:
+                rows &= ~chunk[self.k('Item Number')].isin(existing)
+            if these is not None:
+                rows &= chunk[self.k('Style')].isin(these)
+            if brands is not None:
+                rows &= chunk[self.k('Mill Name')].isin(brands)
+            return rows
+        return select
+
+    def changed_styles(self, frame):
+        """Keep only the styles with items added, changed or removed since the last snapshot."""
+        self._fingerprints = self.fingerprints(frame)
+        changes = self._snapshot.diff(self._fingerprints)
+        self._removed = changes['removed']
+        self.debug(f"Feed changes: {len(changes['new'])} new, {len(changes['changed'])} changed and "
+                   f"{len(changes['removed'])} removed items in {len(changes['styles'])} styles.", True)
+        return frame.loc[frame[self.k('Style')].isin(changes['styles'])]
+
+    def fingerprints(self, frame):
+        """
+        Fingerprint every product row by the columns an import uses, plus the AlphaBroder price.
+
+        fingerprints = {<Item Number>: [<Style>, <Digest>]}
+        """
+        if not self._sanmar:
+            prices = read_feed(os.path.join('files', self._price_file), ['Item Number ', 'Piece'], delimiter='^')
+            frame = frame.assign(Piece=frame['Item Number'].map(dict(zip(prices['Item Number '], prices['Piece']))))
+        digests = pd.util.hash_pandas_object(frame.astype(object), index=False)
+        return {str(item): [str(style), format(digest, 'x')]
+                for item, style, digest in zip(frame[self.k('Item Number')], frame[self.k('Style')], digests)}
+
     def get_description_short(self, item):
         """Get item short description."""
+        from unidecode import unidecode
+        from html import unescape
+
         if self._sanmar:
             return unescape(item["PRODUCT_TITLE"])
         else:
@@ -853,8 +1365,8 @@ class API:
                 return 0
         else:
             if self._prices is None:
-                self._prices = pd.read_csv(os.path.join('files', self._price_file), delimiter='^', engine='python',
-                                           dtype='str')
+                self._prices = read_feed(os.path.join('files', self._price_file), ['Item Number ', 'Piece'],
+                                         delimiter='^')
 
             price = self._prices.loc[self._prices["Item Number "] == item["Item Number"]]
             if not price.empty:
@@ -867,6 +1379,83 @@ class API:
                 price = 0
             return price
 
+    @property
+    def feeds(self):
+        """Supplier feed cache."""
+        return self._feeds
+
+    @property
+    def profile_folder(self):
+        """Folder profiles are written to, or None if profiling is off."""
+        return metrics.profiler.folder if metrics.profiler else None
+
+    @property
+    def levels_per_query(self):
+        """Number of variants whose inventory can be read in one query: within the cost ceiling and at most 250 IDs."""
+        if self._levels_per_query is None:
+            capacity = query_cost.capacity(lambda n: self.levels_query([str(i) for i in range(n)]))
+            self._levels_per_query = min(capacity or query_cost.MAX_IDS, query_cost.MAX_IDS)
+        return self._levels_per_query
+
+    @property
+    def products_per_query(self):
+        """
+        Page size of product searches: GRAPHQL_PRODUCTS_PAGE (default 50), at most 250 and within the cost ceiling.
+
+        A style rarely has more than a few products, so a smaller page mostly saves requested cost.
+        """
+        page = min(int(os.environ.get('GRAPHQL_PRODUCTS_PAGE', 50)), 250)
+        return min(page, query_cost.capacity(lambda n: self.products_query('style', n)))
+
+    @property
+    def stale(self):
+        """Tracker of mapped variants that no longer exist in Shopify."""
+        if self._stale is None:
+            if self._db is None:
+                self._db = self.init_mongodb()
+            self._stale = StaleMappings(self._db)
+        return self._stale
+
+    @property
+    def product_cache(self):
+        """Last known state of Shopify products (see product_cache.py)."""
+        if self._product_cache is None:
+            from product_cache import ProductCache
+
+            if self._db is None:
+                self._db = self.init_mongodb()
+            self._product_cache = ProductCache(self._db)
+        return self._product_cache
+
+    @property
+    def store(self):
+        """Settings of the store this instance syncs."""
+        return self._store
+
+    @property
+    def budget(self):
+        """GraphQL cost budget shared with other workers, or None."""
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        self._budget = budget
+
+    @property
+    def mapping(self):
+        """Product/variant mapping as last loaded from MongoDB."""
+        return self._product_ids
+
+    @property
+    def mapping_version(self):
+        """(<_id>, <_version>) of the stored mapping as last loaded, which changes on every import and prune."""
+        return self._mapping_version
+
+    @property
+    def tracked_variants(self):
+        """Number of variants whose inventory target is known from a previous pass."""
+        return len(self._targets)
+
     def k(self, key):
         """Get key relative to sanmar or alpha product csvs."""
         return k(key, self._sanmar)
@@ -874,42 +1463,49 @@ class API:
     def prepare_products(self):
         """Prepare for updating products by downloading relevant files."""
         if self._sanmar:
-            self.download_sanmar(self._product_file_sanmar)
+            self._feeds.download_all({'sanmar': [self._product_file_sanmar]})
         else:
-            self.download_alpha(self._product_file)
-            self.download_alpha(self._price_file)
+            self._feeds.download_all({'alpha': [self._product_file, self._price_file]})
 
-    def prepare_inventory(self, alpha_only):
-        """Prepare for updating product inventory by downloading relevant files."""
-        self.download_alpha(self._inventory_file)
+    def inventory_files(self, alpha_only=False):
+        """Return the feed files needed for updating inventory, per supplier."""
+        files = {'alpha': [self._inventory_file]}
         if not alpha_only:
-            self.download_sanmar(self._product_file_sanmar)
+            files['sanmar'] = [self._product_file_sanmar]
+        return files
 
-    def download_alpha(self, filename):
-        """Download the given file."""
-        domain = os.environ["FTP_DOMAIN_ALPHA"]
-        user = os.environ["FTP_USERNAME_ALPHA"]
-        passwd = os.environ["FTP_PASSWORD_ALPHA"]
-
-        ftp = FTP_TLS(domain)
-        ftp.login(user=user, passwd=passwd)
-
-        self.download_file(ftp, filename)
-
-        ftp.quit()
-
-    def download_sanmar(self, filename):
-        """Download the given file."""
-        domain = os.environ["FTP_DOMAIN_SANMAR"]
-        user = os.environ["FTP_USERNAME_SANMAR"]
-        passwd = os.environ["FTP_PASSWORD_SANMAR"]
-
-        ftp = FTP(domain)
-        ftp.login(user=user, passwd=passwd)
+    def prepare_inventory(self, alpha_only):
+        """
+        Build the quantity indexes for updating product inventory, downloading the files first if enabled.
+
+        The indexes are built from the FTP transfer as it streams in, so no separate parsing pass is needed. They are
+        kept between passes and only rebuilt when a file changed, or for SanMar when the mapping did.
+
+        quantities = {'alpha': {<Item Number>: <Total Inventory - DROP SHIP>},
+                      'sanmar': {<UNIQUE_KEY>: <QTY>}}
+        """
+        files = self.inventory_files(alpha_only)
+        if self._inventory_file not in self._indexes:
+            self._indexes[self._inventory_file] = QuantityIndex('Item Number', k("Total Inventory", False), 'DROP SHIP')
+        if not alpha_only and (self._product_file_sanmar not in self._indexes
+                               or self._indexes_version != self._mapping_version):
+            # The SanMar file is the whole national catalog. Only the mapped items are kept once the mapping is loaded.
+            mapped = set(self.mapping_table()['sanmar'].dropna()) if self._product_ids else None
+            self._indexes[self._product_file_sanmar] = QuantityIndex(k('Item Number', True), k("Total Inventory", True),
+                                                                     keep=mapped)
+            self._indexes_version = self._mapping_version
+        parsers = {filename: self._indexes[filename] for names in files.values() for filename in names}
 
-        self.download_file(ftp, filename, dir='SanMarPDD/')
+        if self._download:
+            self._feeds.download_all(files, parsers)
+        else:
+            for filename, parser in parsers.items():
+                self._feeds.refresh(filename, parser)
 
-        ftp.quit()
+        quantities = {'alpha': parsers[self._inventory_file].quantities, 'sanmar': {}}
+        if not alpha_only:
+            quantities['sanmar'] = parsers[self._product_file_sanmar].quantities
+        return quantities
 
     # def find_images(self):
     #     """Find all images."""
@@ -923,7 +1519,7 @@ class API:
     #             progress.append(p)
 
     def _clean(self):
-        """Remove all downloaded files."""
+        """Remove all downloaded images. Feed files are kept in the cache for the next run."""
         folder = 'images'
         for the_file in os.listdir(folder):
             file_path = os.path.join(folder, the_file)
@@ -933,37 +1529,20 @@ class API:
             except Exception as e:
                 print(e)
 
-        if self._download:
-            for f in [self._inventory_file, self._product_file, self._price_file, self._product_file_sanmar]:
-                if os.path.isfile(os.path.join('files', f)):
-                    os.unlink(os.path.join('files', f))
-
-    @staticmethod
-    def init_mongodb():
-        """Initialize MongoDB Client."""
-        client = pymongo.MongoClient(os.environ["MONGODB_URL"])
-        return client.bulkthreads
+    def init_mongodb(self):
+        """Initialize MongoDB Client for the store's database."""
+        return self._store.database()
 
     @staticmethod
     def _sanitize_records(records):
-        """Return records without the default mongodb _id to avoid conflicts on save"""
+        """Return records without the default mongodb _id (or the mapping's _version) to avoid conflicts on save"""
         try:
             records = [item for item in records][0]
         except IndexError:
             records = []
-        records = {key: records[key] for key in records if key != '_id'}
+        records = {key: records[key] for key in records if key not in ('_id', '_version')}
         return records
 
-    def download_file(self, ftp, filename, dir=''):
-        """Download given file from global FTP server."""
-
-        download_to = os.path.join('files', filename)
-        self.debug("Downloading '{}' to: {}".format(filename, download_to))
-
-        local_file = open(download_to, 'wb')
-        ftp.retrbinary(f'RETR {dir}{filename}', local_file.write)
-        local_file.close()
-
     def debug(self, msg, force=False):
         """Method for printing debug messages."""
         if self._debug or force:
@@ -994,21 +1573,21 @@ def k(key, sanmar):
         return key
 
 
-def save(obj, t=300):
-    """Save shopify object."""
+def save(obj, defer=False):
+    """
+    Save shopify object, retrying transient errors with backoff (see retry.py).
+
+    Return False if it could not be saved. With defer=True a transient error raises retry.Transient right away so the
+    caller can retry the object later instead of waiting.
+    """
     errors = (SSLEOFError, URLError, HTTPError, RemoteDisconnected, ResourceNotFound, BadRequest, Error, ValueError)
     try:
-        obj.save()
-    except errors:
-        sleep(t)
-        try:
-            obj.save()
-        except errors as e:
-            sleep(t)
-            print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), e))
-            print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                     traceback.format_exc()))
-            s = "Could not save {}".format(obj.__dict__)
-            print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), s))
-            return False
+        retry.call(obj.save, defer=defer)
+    except errors as e:
+        print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), e))
+        print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                 traceback.format_exc()))
+        s = "Could not save {}".format(obj.__dict__)
+        print("<{}>: {}%".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), s))
+        return False
     return True
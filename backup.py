@@ -0,0 +1,167 @@
+"""
+Back up and restore the MongoDB mapping store as compressed NDJSON.
+
+    $ python backup.py dump --folder backups
+    $ python backup.py restore backups/bulkthreads-20201001-120000.ndjson.gz --url mongodb://localhost --drop
+
+Each line holds up to BACKUP_BATCH keys (default 1000) of one document:
+
+    {"backup": 1, "database": ..., "created": ...}
+    {"c": <Collection>, "_id": <Document ID>, "part": {<Key>: <Value>, ...}}
+    ...
+    {"end": {<Collection>: <Documents>}, "lines": <Lines>, "sha256": <Checksum of every line before this one>}
+
+Values are written as MongoDB extended JSON, so IDs and dates survive a round trip. The mapping is kept as one
+document per collection, so a document is only held in memory while it is written or restored.
+"""
+import os
+import gzip
+import hashlib
+from datetime import datetime
+import click
+import pymongo
+from bson import json_util
+from dotenv import load_dotenv
+
+COLLECTIONS = ('products', 'inventory')
+
+
+def batch_size():
+    """Keys written per line and documents inserted per bulk write (BACKUP_BATCH, default 1000)."""
+    return int(os.environ.get('BACKUP_BATCH', 1000))
+
+
+def dump(db, path, collections=COLLECTIONS, batch=None):
+    """Stream the given collections to a compressed NDJSON file. Return {<Collection>: <Documents>}."""
+    batch = batch or batch_size()
+    digest = hashlib.sha256()
+    counts = {}
+    lines = 0
+    tmp = f'{path}.tmp'
+    with gzip.open(tmp, 'wb') as f:
+        def write(record):
+            line = (json_util.dumps(record) + '\n').encode('utf-8')
+            digest.update(line)
+            f.write(line)
+
+        write({'backup': 1, 'database': db.name, 'created': datetime.utcnow().isoformat()})
+        lines += 1
+        for collection in collections:
+            counts[collection] = 0
+            for doc in db[collection].find():
+                keys = [key for key in doc if key != '_id']
+                for i in range(0, max(len(keys), 1), batch):
+                    write({'c': collection, '_id': doc['_id'], 'part': {key: doc[key] for key in keys[i:i + batch]}})
+                    lines += 1
+                counts[collection] += 1
+        footer = {'end': counts, 'lines': lines, 'sha256': digest.hexdigest()}
+        f.write((json_util.dumps(footer) + '\n').encode('utf-8'))
+    os.replace(tmp, path)
+    return counts
+
+
+def verify(path):
+    """Check a backup's checksum without loading it. Return its footer, or raise ValueError if it is damaged."""
+    digest = hashlib.sha256()
+    lines = 0
+    footer = None
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            if footer is not None:
+                raise ValueError(f"{path}: data after the end of the backup.")
+            record = json_util.loads(line)
+            if 'end' in record:
+                footer = record
+                continue
+            digest.update(line)
+            lines += 1
+    if footer is None:
+        raise ValueError(f"{path}: truncated, the end of the backup is missing.")
+    if footer['lines'] != lines or footer['sha256'] != digest.hexdigest():
+        raise ValueError(f"{path}: checksum mismatch.")
+    return footer
+
+
+def restore(db, path, drop=False, batch=None):
+    """
+    Verify a backup and insert its documents in bulk. Return {<Collection>: <Documents>}.
+
+    Collections in the backup must be empty unless drop=True, which clears them first.
+    """
+    batch = batch or batch_size()
+    footer = verify(path)
+    for collection in footer['end']:
+        if drop:
+            db[collection].delete_many({})
+        elif db[collection].estimated_document_count():
+            raise ValueError(f"Collection '{collection}' is not empty. Restore with --drop to replace it.")
+
+    counts = {collection: 0 for collection in footer['end']}
+    pending = {}
+    current = None
+
+    def flush(collection):
+        docs = pending.pop(collection, [])
+        if docs:
+            db[collection].insert_many(docs, ordered=False)
+            counts[collection] += len(docs)
+
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            record = json_util.loads(line)
+            if 'c' not in record:
+                continue
+            if current is None or (current[0], current[1]['_id']) != (record['c'], record['_id']):
+                if current is not None:
+                    pending.setdefault(current[0], []).append(current[1])
+                    if len(pending[current[0]]) >= batch:
+                        flush(current[0])
+                current = (record['c'], {'_id': record['_id']})
+            current[1].update(record['part'])
+    if current is not None:
+        pending.setdefault(current[0], []).append(current[1])
+    for collection in list(pending):
+        flush(collection)
+    return counts
+
+
+@click.group()
+def main():
+    """Mapping store backups."""
+    load_dotenv()
+
+
+@main.command('dump')
+@click.option('--folder', '-f', default='backups', help='Folder for the backup file.')
+@click.option('--collection', '-c', multiple=True, default=COLLECTIONS, help='Collections to back up.')
+@click.option('--url', default=None, help='MongoDB URL (default MONGODB_URL).')
+@click.option('--database', default='bulkthreads', help='Database name.')
+def dump_command(folder, collection, url, database):
+    """Write a backup of the mapping store."""
+    db = pymongo.MongoClient(url or os.environ['MONGODB_URL'])[database]
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{database}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz")
+    counts = dump(db, path, collection)
+    print(f"Saved {', '.join(f'{n} {c}' for c, n in counts.items())} documents to {path}.")
+
+
+@main.command('restore')
+@click.argument('path')
+@click.option('--url', default=None, help='MongoDB URL to restore into (default MONGODB_URL).')
+@click.option('--database', default='bulkthreads', help='Database name.')
+@click.option('--drop', is_flag=True, help='Replace the collections if they already hold documents.')
+@click.option('--verify-only', is_flag=True, help='Only check the backup.')
+def restore_command(path, url, database, drop, verify_only):
+    """Restore a backup of the mapping store."""
+    if verify_only:
+        footer = verify(path)
+        print(f"{path} is intact: {', '.join(f'{n} {c}' for c, n in footer['end'].items())} documents.")
+        return
+    db = pymongo.MongoClient(url or os.environ['MONGODB_URL'])[database]
+    counts = restore(db, path, drop)
+    print(f"Restored {', '.join(f'{n} {c}' for c, n in counts.items())} documents from {path}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Synthetic-scale benchmarks for the integration. Run with `python -m benchmarks.run`."""
@@ -0,0 +1,130 @@
+"""Generate realistic AlphaBroder and SanMar feed files of a given size."""
+import os
+import csv
+import random
+
+COLORS = ['Black', 'White', 'Navy', 'Red', 'Royal', 'Sport Grey', 'Charcoal', 'Forest Green', 'Maroon', 'Gold']
+SIZES = ['XS', 'S', 'M', 'L', 'XL', '2XL', '3XL', '4XL']
+MILLS = ['Gildan', 'Bella + Canvas', 'Jerzees', 'Hanes', 'Port Authority', 'Sport-Tek']
+CATEGORIES = ['T-Shirts', 'Polos', 'Fleece', 'Outerwear']
+
+ALPHA_PRODUCT_COLUMNS = [
+    "Catalog Page Number", "NEW", "Item Number", "Style", "Short Description", "Color Code", "Size Code", "Case Qty",
+    "Weight", "Mill #", "Mill Name", "Category", "Subcategory", "Thumbnail Name", "Normal Image Name",
+    "Full Feature Description", "Brand Page Number", "Front of Image Name", "Back of Image Name",
+    "Side of Image Name", "Gtin", "Launch Date", "PMS Color", "Size Sort Order", "Color Name", "Size"
+]
+ALPHA_PRICE_COLUMNS = ["Item Number ", "Piece", "Dozen", "Case"]
+ALPHA_INVENTORY_COLUMNS = ["Item Number", "CC", "CN", "FO", "KC", "PH", "TD", "GD", "DROP SHIP", "Total Inventory"]
+SANMAR_COLUMNS = [
+    "UNIQUE_KEY", "PRODUCT_TITLE", "PRODUCT_DESCRIPTION", "STYLE#", "AVAILABLE_SIZES", "BRAND_LOGO_IMAGE",
+    "THUMBNAIL_IMAGE", "COLOR_SWATCH_IMAGE", "PRODUCT_IMAGE", "SPEC_SHEET", "PRICE_TEXT", "SUGGESTED_PRICE",
+    "CATEGORY_NAME", "SUBCATEGORY_NAME", "COLOR_NAME", "COLOR_SQUARE_IMAGE", "COLOR_PRODUCT_IMAGE",
+    "COLOR_PRODUCT_IMAGE_THUMBNAIL", "SIZE", "QTY", "PIECE_WEIGHT", "PIECE_PRICE", "DOZENS_PRICE", "CASE_PRICE",
+    "PRICE_GROUP", "CASE_SIZE", "INVENTORY_KEY", "SIZE_INDEX", "SANMAR_MAINFRAME_COLOR", "MILL", "PRODUCT_STATUS",
+    "COMPANION_STYLES", "MSRP", "MAP_PRICING", "FRONT_MODEL_IMAGE_URL", "BACK_MODEL_IMAGE", "FRONT_FLAT_IMAGE",
+    "BACK_FLAT_IMAGE", "PRODUCT_MEASUREMENTS", "PMS_COLOR", "GTIN"
+]
+
+DESCRIPTION = ("5.3 oz., 100% preshrunk cotton; Sport Grey is 90/10 cotton/polyester; Double-needle sleeves and hem; "
+               "Taped neck and shoulders; Seamless collar; Tear away label; Quarter-turned to eliminate center crease")
+
+
+def items(rows, prefix):
+    """Yield (style, color, size, item number) for the given number of rows, grouped by style."""
+    per_style = len(COLORS) * len(SIZES)
+    for i in range(rows):
+        style = f'{prefix}{1000 + i // per_style}'
+        color = COLORS[(i % per_style) // len(SIZES)]
+        size = SIZES[i % len(SIZES)]
+        yield style, color, size, f'{style}{(i % per_style):03d}'
+
+
+def alpha_feeds(folder, rows, seed=0):
+    """Write the AlphaBroder product ('^'), price ('^') and inventory (CSV) files."""
+    rnd = random.Random(seed)
+    with open(os.path.join(folder, 'AllDBInfoALP_Prod.txt'), 'w', newline='') as p, \
+            open(os.path.join(folder, 'AllDBInfoALP_PRC_RZ19.txt'), 'w', newline='') as pr, \
+            open(os.path.join(folder, 'inventory-v8-alp.txt'), 'w', newline='') as inv:
+        products = csv.writer(p, delimiter='^', quoting=csv.QUOTE_MINIMAL)
+        prices = csv.writer(pr, delimiter='^')
+        inventory = csv.writer(inv)
+        products.writerow(ALPHA_PRODUCT_COLUMNS)
+        prices.writerow(ALPHA_PRICE_COLUMNS)
+        inventory.writerow(ALPHA_INVENTORY_COLUMNS)
+        for style, color, size, item in items(rows, 'A'):
+            mill = MILLS[int(style[1:]) % len(MILLS)]
+            category = CATEGORIES[int(style[1:]) % len(CATEGORIES)]
+            image = f'{style}_{color.replace(" ", "")}_ff.jpg'
+            products.writerow([
+                rnd.randint(1, 400), '', item, style, f'{category[:-1]} {style}', color[:3].upper(), size, 72, 0.4,
+                style, mill, category, 'Short Sleeve', image, image, DESCRIPTION, rnd.randint(1, 40), image,
+                image.replace('_ff', '_fb'), image.replace('_ff', '_fs'), f'{rnd.randint(10 ** 11, 10 ** 12)}',
+                '2019-01-01', '', SIZES.index(size), color.upper(), size
+            ])
+            prices.writerow([item, rnd.randint(3, 30), rnd.randint(30, 300), rnd.randint(300, 3000)])
+            warehouses = [rnd.choice([0, 0, rnd.randint(0, 500)]) for _ in range(7)]
+            drop_ship = rnd.choice([0, 0, 0, rnd.randint(0, 20)])
+            inventory.writerow([item] + warehouses + [drop_ship, sum(warehouses) + drop_ship])
+
+
+def sanmar_feed(folder, rows, seed=0, image_url=''):
+    """Write the SanMar EPDD file."""
+    rnd = random.Random(seed + 1)
+    with open(os.path.join(folder, 'SanMar_EPDD.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(SANMAR_COLUMNS)
+        for style, color, size, item in items(rows, 'S'):
+            mill = MILLS[int(style[1:]) % len(MILLS)]
+            category = CATEGORIES[int(style[1:]) % len(CATEGORIES)]
+            url = f'{image_url}{style}_{color.replace(" ", "")}_model_front.jpg'
+            row = {c: '' for c in SANMAR_COLUMNS}
+            row.update({
+                'UNIQUE_KEY': item, 'PRODUCT_TITLE': f'{mill} {category[:-1]} {style}',
+                'PRODUCT_DESCRIPTION': DESCRIPTION.replace(';', '|'), 'STYLE#': style,
+                'AVAILABLE_SIZES': f'{SIZES[0]}-{SIZES[-1]}', 'CATEGORY_NAME': category, 'COLOR_NAME': color,
+                'SIZE': size, 'QTY': rnd.choice([0, rnd.randint(0, 5000)]), 'MILL': mill,
+                'PRODUCT_STATUS': 'Active', 'MSRP': rnd.randint(5, 40), 'MAP_PRICING': rnd.randint(5, 40),
+                'FRONT_MODEL_IMAGE_URL': url, 'PRODUCT_IMAGE': url.replace('model_front', 'flat'),
+                'BACK_MODEL_IMAGE': url.replace('front', 'back'), 'THUMBNAIL_IMAGE': url.replace('front', 'thumb'),
+                'COLOR_PRODUCT_IMAGE': url, 'SPEC_SHEET': f'{image_url}{style}_spec.pdf',
+                'PRODUCT_MEASUREMENTS': f'{image_url}{style}_measurements.pdf', 'GTIN': rnd.randint(10 ** 11, 10 ** 12)
+            })
+            writer.writerow([row[c] for c in SANMAR_COLUMNS])
+
+
+def catalog(rows, sanmar_rows=None, seed=0):
+    """
+    Build the Shopify catalog and Mongo mapping matching the generated feeds.
+
+    Every style becomes one product with one variant per color/size. AlphaBroder and SanMar items with the same
+    position share a variant so that both suppliers contribute to its inventory.
+
+    Return (products, mapping) where products = [{"id": ..., "title": ..., "variants": [...]}] and
+    mapping = {<Product ID>: {<Variant ID>: {"alpha": <Item Number>, "sanmar": <UNIQUE_KEY>}}}.
+    """
+    rnd = random.Random(seed + 2)
+    sanmar_rows = rows if sanmar_rows is None else sanmar_rows
+    sanmar_items = [item for _, _, _, item in items(sanmar_rows, 'S')]
+    products = {}
+    mapping = {}
+    vid = 10 ** 9
+    for i, (style, color, size, item) in enumerate(items(rows, 'A')):
+        pid = str(10 ** 8 + int(style[1:]))
+        mill = MILLS[int(style[1:]) % len(MILLS)]
+        category = CATEGORIES[int(style[1:]) % len(CATEGORIES)]
+        product = products.setdefault(pid, {
+            'id': int(pid), 'title': f'{mill} {style}: {category[:-1]} {style}', 'handle': f'{style.lower()}',
+            'body_html': '', 'vendor': mill, 'product_type': category,
+            'options': [{'name': 'Size', 'position': 1}, {'name': 'Color', 'position': 2}], 'variants': []
+        })
+        vid += 1
+        product['variants'].append({
+            'id': vid, 'product_id': int(pid), 'option1': size, 'option2': color.upper(), 'option3': None,
+            'price': '10.00', 'inventory_quantity': rnd.randint(0, 500), 'inventory_item_id': vid + 10 ** 9
+        })
+        entry = {'alpha': item}
+        if i < len(sanmar_items):
+            entry['sanmar'] = sanmar_items[i]
+        mapping.setdefault(pid, {})[str(vid)] = entry
+    return list(products.values()), mapping
@@ -0,0 +1,99 @@
+"""
+Compare the memory used by the product feed loaders.
+
+    $ python -m benchmarks.memory --rows 100000 --rows 500000
+
+"legacy" reads every column as a string, as product imports used to. "compact" reads the columns of an import with
+repeated values as categoricals, and "workers" is the slice pickled into the namespace shared with the save workers.
+"chunked" reads the file in chunks and keeps only the rows of one category, as an import selecting a quarter of the
+catalog does.
+"""
+import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter
+import click
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import generate  # noqa: E402
+
+
+def measure(name, load):
+    """Load a frame and return its size in memory, pickled size, peak allocation and load time."""
+    tracemalloc.start()
+    start = perf_counter()
+    frame = load()
+    wall = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'loader': name,
+        'columns': frame.shape[1],
+        'wall_time': round(wall, 3),
+        'frame_mb': round(frame.memory_usage(deep=True).sum() / 2 ** 20, 2),
+        'pickled_mb': round(len(pickle.dumps(frame)) / 2 ** 20, 2),
+        'load_peak_mb': round(peak / 2 ** 20, 2)
+    }
+
+
+def run(rows):
+    """Measure the loaders on generated AlphaBroder and SanMar product files."""
+    from api import API, k
+    from feeds import read_feed
+
+    results = []
+    folder = tempfile.mkdtemp(prefix=f'bench-memory-{rows}-')
+    try:
+        generate.alpha_feeds(folder, rows)
+        generate.sanmar_feed(folder, rows)
+        for sanmar, filename, delimiter in ((False, API._product_file, '^'), (True, API._product_file_sanmar, ',')):
+            path = os.path.join(folder, filename)
+            columns = [k(c, sanmar) for c in API._product_columns]
+            columns += API._product_columns_sanmar if sanmar else API._product_columns_alpha
+            values = (k('Item Number', sanmar), 'MAP_PRICING')
+            save_columns = [k(c, sanmar) for c in API._save_columns]
+
+            def compact():
+                return read_feed(path, columns, [c for c in columns if c not in values], delimiter)
+
+            category = k('Category', sanmar)
+
+            def chunked():
+                return read_feed(path, columns, [c for c in columns if c not in values], delimiter,
+                                 select=lambda chunk: chunk[category] == generate.CATEGORIES[0])
+
+            for result in (
+                    measure('legacy', lambda: pd.read_csv(path, delimiter=delimiter, engine='python', dtype='str')),
+                    measure('compact', compact),
+                    measure('workers', lambda: compact()[save_columns]),
+                    measure('chunked', chunked)):
+                results.append(dict(result, feed='sanmar' if sanmar else 'alpha'))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+@click.command()
+@click.option('--rows', '-r', multiple=True, type=int, default=[100000], help='Feed sizes.')
+@click.option('--output', '-o', default=None, help='JSON report.')
+def main(rows, output):
+    """Product feed memory benchmark."""
+    report = {}
+    for n in rows:
+        print(f'== {n} rows ==')
+        report[n] = run(n)
+        for result in report[n]:
+            print('  ' + ', '.join(f'{key}: {value}' for key, value in result.items()))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
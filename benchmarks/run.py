@@ -0,0 +1,148 @@
+"""
+Benchmark update_inventory and update_products against generated feeds, a fake Shopify store and a seeded mapping.
+
+    $ python -m benchmarks.run --rows 10000 --rows 100000 --phases inventory,inventory-delta,products
+
+MongoDB is mongomock when installed, otherwise the server at MONGODB_URL (i.e. a local mongod). Results are printed
+per phase and written to --output as JSON.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import traceback
+import tracemalloc
+import resource
+from time import perf_counter
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import generate  # noqa: E402
+from benchmarks.fake_shopify import FakeShopify  # noqa: E402
+
+PHASES = ['inventory', 'inventory-delta', 'products']
+
+
+def mongo():
+    """Return a MongoDB database for the benchmark."""
+    try:
+        import mongomock
+        return mongomock.MongoClient().bench
+    except ImportError:
+        import pymongo
+        client = pymongo.MongoClient(os.environ.get('MONGODB_URL', 'mongodb://localhost:27017'))
+        client.drop_database('bench')
+        return client.bench
+
+
+def measure(name, store, func):
+    """Run one phase and return its measurements."""
+    from metrics import metrics
+    store.reset_stats()
+    metrics.last = None
+    tracemalloc.start()
+    start = perf_counter()
+    error = None
+    try:
+        func()
+    except Exception as e:
+        traceback.print_exc()
+        error = repr(e)
+    wall = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = sum(store.stats['calls'].values())
+    return {
+        'phase': name,
+        'wall_time': round(wall, 3),
+        'calls': calls,
+        'calls_per_second': round(calls / wall, 2) if wall else 0,
+        'calls_by_kind': dict(store.stats['calls']),
+        'python_peak_mb': round(peak / 2 ** 20, 2),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, 2),
+        'throttled': store.stats['throttled'],
+        'throttle_wait_advised': round(store.stats['retry_after'], 2),
+        'graphql_requested_cost': store.stats['requested_cost'],
+        'graphql_actual_cost': store.stats['actual_cost'],
+        'server_errors': store.stats['errors'],
+        'rejected_queries': store.stats['rejected'],
+        'error': error,
+        'client_phases': metrics.last['phases'] if metrics.last else None
+    }
+
+
+def run(rows, phases, limit, restore_rate, error_rate, threads):
+    """Run the benchmark for one feed size in a scratch directory."""
+    from api import API
+
+    results = []
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix=f'bench-{rows}-')
+    store = FakeShopify(graphql_restore=restore_rate, error_rate=error_rate)
+    try:
+        os.chdir(folder)
+        os.mkdir('files')
+        os.mkdir('images')
+        url = store.start()
+
+        start = perf_counter()
+        generate.alpha_feeds('files', rows)
+        generate.sanmar_feed('files', rows, image_url=f'{store.base_url}/images/')
+        products, mapping = generate.catalog(rows)
+        store.seed(products)
+        db = mongo()
+        db.products.delete_many({})
+        db.inventory.delete_many({})
+        db.products.insert_one(mapping)
+        results.append({'phase': 'generate', 'wall_time': round(perf_counter() - start, 3)})
+
+        os.environ.update({
+            'SHOPIFY_URL': url, 'SHOPIFY_LOCATION': '1', 'ALPHA_IMAGE_URL': f'{store.base_url}/images/',
+            'CATEGORIES': ','.join(generate.CATEGORIES), 'NUM_THREADS': str(threads), 'METRICS_FOLDER': ''
+        })
+        os.environ.pop('ONLY_THESE', None)
+        api = API(False, False)
+        api._db = db
+
+        for phase in phases:
+            if phase == 'inventory':
+                func = api.update_inventory
+            elif phase == 'inventory-delta':
+                # Change a slice of the AlphaBroder inventory so a delta pass has something to do.
+                generate.alpha_feeds('files', rows, seed=1)
+                func = lambda: api.update_inventory(full=False)  # noqa: E731
+            else:
+                func = lambda: api.update_products(limit=limit, skip_existing=False)  # noqa: E731
+            results.append(measure(phase, store, func))
+    finally:
+        os.chdir(cwd)
+        store.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+@click.command()
+@click.option('--rows', '-r', multiple=True, type=int, default=[10000, 100000, 500000], help='Feed sizes.')
+@click.option('--phases', '-p', default=','.join(PHASES), help='Comma-separated phases to run.')
+@click.option('--limit', '-l', default=1000, help='Product rows processed by the products phase.')
+@click.option('--restore-rate', default=50.0, help='GraphQL points restored per second by the fake store.')
+@click.option('--error-rate', default=0.0, help='Fraction of requests answered with a 500.')
+@click.option('--threads', default=4, help='NUM_THREADS for the products phase.')
+@click.option('--output', '-o', default='bench_output.json', help='JSON report.')
+def main(rows, phases, limit, restore_rate, error_rate, threads, output):
+    """Synthetic-scale benchmark."""
+    report = {}
+    for n in rows:
+        print(f'== {n} rows ==')
+        report[n] = run(n, [p for p in phases.split(',') if p], limit, restore_rate, error_rate, threads)
+        for result in report[n]:
+            print('  ' + ', '.join(f'{key}: {value}' for key, value in result.items()
+                                   if key not in ('calls_by_kind', 'client_phases') and value is not None))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
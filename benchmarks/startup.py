@@ -0,0 +1,63 @@
+"""
+Measure how long the entry points take to start.
+
+    $ python -m benchmarks.startup --repeat 10
+
+Each command runs in a fresh interpreter and the median wall time is reported. "sync ready" is how long sync.py takes
+before it can start downloading, "api import" the work it overlaps with the download, and "integration" the start-up
+of the full entry point. The modules an inventory pass loads are listed, so product-only imports creeping back in show.
+"""
+import os
+import sys
+import json
+import subprocess
+from statistics import median
+from time import perf_counter
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'python': 'pass',
+    'sync ready': 'import sync',
+    'api import': 'import api',
+    'integration': 'import integration; from api import API',
+}
+
+# Modules only product imports need.
+PRODUCT_ONLY = ['unidecode', 'multiprocessing', 'profiling', 'checkpoint', 'snapshot']
+
+
+def timed(code, repeat):
+    """Median seconds to run `python -c code` in the repo."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+        times.append(perf_counter() - start)
+    return median(times)
+
+
+def loaded():
+    """Product-only modules loaded by importing the API."""
+    code = f"import sys, api; print(','.join(m for m in {PRODUCT_ONLY!r} if m in sys.modules))"
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True)
+    return [m for m in output.stdout.strip().split(',') if m]
+
+
+@click.command()
+@click.option('--repeat', '-r', type=int, default=5, help='Runs per command.')
+@click.option('--output', '-o', default=None, help='JSON report.')
+def main(repeat, output):
+    """Entry point start-up benchmark."""
+    report = {name: round(timed(code, repeat), 3) for name, code in COMMANDS.items()}
+    report['product_only_modules'] = loaded()
+    for key, value in report.items():
+        print(f'{key}: {value}')
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Durable per-style checkpoints for resumable product imports."""
+import os
+import json
+
+
+class Checkpoint:
+    """
+    Append-only record of the styles an import has finished, one JSON line per style.
+
+    {"style": <Style>, "ids": {<Item Number>: {"variant_id": ..., "product_id": ...}}}
+
+    Every line is written with a single write on a file opened for appending and synced to disk, so several save
+    processes can record styles concurrently and a crash loses at most the style in progress.
+    """
+
+    def __init__(self, name, folder='checkpoints'):
+        self._folder = folder
+        self._path = os.path.join(folder, f'{name}.jsonl')
+
+    @property
+    def path(self):
+        """Location of the checkpoint file."""
+        return self._path
+
+    def record(self, style, ids):
+        """Durably record a finished style and the IDs of its items."""
+        if not os.path.exists(self._folder):
+            os.makedirs(self._folder, exist_ok=True)
+        line = (json.dumps({'style': style, 'ids': ids}) + '\n').encode('utf-8')
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self):
+        """Return {<Style>: {<Item Number>: {...}}} of finished styles. A torn last line is ignored."""
+        styles = {}
+        if not os.path.isfile(self._path):
+            return styles
+        with open(self._path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                styles.setdefault(entry['style'], {}).update(entry['ids'])
+        return styles
+
+    def clear(self):
+        """Forget all finished styles."""
+        if os.path.isfile(self._path):
+            os.unlink(self._path)
@@ -0,0 +1,128 @@
+"""Long-lived inventory sync daemon with a local control and health endpoint."""
+import os
+import json
+import traceback
+from datetime import datetime
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from time import monotonic
+
+from scheduler import Scheduler
+from metrics import metrics
+
+
+class SyncDaemon:
+    """
+    Keep one warm API instance alive across inventory passes.
+
+    The Shopify client, MongoDB connection, product mapping, feed quantity indexes and the inventory levels and targets
+    of the previous pass are reused, so a pass only re-parses feeds that changed and only reads and adjusts variants
+    whose supplier quantity changed. Every `full_every` passes (DAEMON_FULL_EVERY, default 24) a full pass re-reads
+    everything to correct drift from sales and manual edits in Shopify. Run reports are rotated as in any other mode
+    (see `metrics.write_report`).
+
+    Control endpoint (127.0.0.1:DAEMON_PORT, default 8765):
+        GET  /health - JSON status
+        GET  /metrics - Prometheus metrics
+        POST /sync   - run a pass now
+        POST /full   - run a full pass now
+        POST /stop   - stop after the current pass
+    """
+
+    def __init__(self, api, port=None, full_every=None, min_interval=None):
+        self._api = api
+        self._port = int(port if port is not None else os.environ.get('DAEMON_PORT', 8765))
+        self._full_every = int(full_every if full_every is not None else os.environ.get('DAEMON_FULL_EVERY', 24))
+        self._scheduler = Scheduler(api, api.inventory_files(), min_interval=min_interval, sync=self.sync)
+        self._started = monotonic()
+        self._passes = 0
+        self._full_next = True
+        self._last_pass = None
+        self._last_error = None
+        self._running = False
+        self._server = None
+
+    def run(self):
+        """Start the control endpoint and sync until stopped."""
+        self._server = HTTPServer(('127.0.0.1', self._port), self.handler())
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        self._api.debug(f"Daemon listening on 127.0.0.1:{self._port}.", True)
+        try:
+            self._scheduler.run()
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def sync(self):
+        """Run one inventory pass, full if due."""
+        full = self._full_next or (self._full_every > 0 and self._passes % self._full_every == 0)
+        self._running = True
+        try:
+            self._api.update_inventory(full=full)
+            self._full_next = False
+            self._last_error = None
+        except Exception:
+            self._last_error = traceback.format_exc()
+            raise
+        finally:
+            self._running = False
+            self._passes += 1
+            self._last_pass = {'at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'full': full}
+
+    def full(self):
+        """Run a full pass as soon as possible."""
+        self._full_next = True
+        self._scheduler.request()
+
+    def health(self):
+        """Return the daemon status."""
+        return {
+            'status': 'error' if self._last_error else 'ok',
+            'running': self._running,
+            'uptime': int(monotonic() - self._started),
+            'passes': self._passes,
+            'last_pass': self._last_pass,
+            'last_error': self._last_error,
+            'products': len(self._api.mapping),
+            'variants': self._api.tracked_variants
+        }
+
+    def handler(self):
+        """Build the request handler class bound to this daemon."""
+        daemon = self
+        actions = {'/sync': self._scheduler.request, '/full': self.full, '/stop': self._scheduler.stop}
+
+        class Handler(BaseHTTPRequestHandler):
+            """Local control requests."""
+
+            def do_GET(self):
+                """Health check."""
+                if self.path == '/health':
+                    self.respond(200, daemon.health())
+                elif self.path == '/metrics':
+                    self.respond(200, metrics.prometheus().encode('utf-8'))
+                else:
+                    self.respond(404, {'error': 'Not found'})
+
+            def do_POST(self):
+                """Control actions."""
+                if self.path in actions:
+                    actions[self.path]()
+                    self.respond(202, {'accepted': self.path.strip('/')})
+                else:
+                    self.respond(404, {'error': 'Not found'})
+
+            def respond(self, code, body):
+                """Send a JSON (or already encoded text) response."""
+                data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'text/plain' if isinstance(body, bytes) else 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                """Only log requests in verbose mode."""
+                daemon._api.debug(format % args)
+
+        return Handler
@@ -0,0 +1,371 @@
+"""Supplier FTP feed downloads backed by a persistent local cache."""
+import os
+import csv
+import json
+import codecs
+import ftplib
+from ftplib import FTP_TLS, FTP
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Files every inventory pass needs, per supplier.
+INVENTORY_FILES = {'alpha': ['inventory-v8-alp.txt'], 'sanmar': ['SanMar_EPDD.csv']}
+
+SUPPLIERS = {
+    'alpha': {'env': 'ALPHA', 'tls': True, 'dir': ''},
+    'sanmar': {'env': 'SANMAR', 'tls': False, 'dir': 'SanMarPDD/'}
+}
+
+
+class FeedCache:
+    """
+    Download supplier feed files, skipping any file that is unchanged on the server.
+
+    Every cached file has an entry in `feeds.json` inside the cache folder:
+
+    _meta = {<Filename>: {
+        "modified": <MDTM timestamp>,
+        "size": <SIZE in bytes>,
+        "complete": <False while a transfer is in progress>
+    }}
+
+    An incomplete transfer is kept as `<Filename>.part` and resumed with REST on the next attempt as long as the
+    remote file has not changed in the meantime.
+    """
+    _meta_file = 'feeds.json'
+    _attempts = 3
+
+    def __init__(self, folder='files', debug=None):
+        self._folder = folder
+        self._debug = debug
+        self._lock = Lock()
+        if not os.path.exists(self._folder):
+            os.mkdir(self._folder)
+        self._meta = self._load_meta()
+
+    def download_all(self, files, parsers=None):
+        """
+        Download {<Supplier>: [<Filename>, ...]} with one session per supplier, all suppliers in parallel.
+
+        parsers = {<Filename>: <StreamParser>} are fed each file as it arrives, or from the cache if unchanged.
+        """
+        changed = {}
+        with ThreadPoolExecutor(max_workers=max(len(files), 1)) as executor:
+            futures = [executor.submit(self.download, supplier, filenames, parsers)
+                       for supplier, filenames in files.items()]
+            for future in futures:
+                changed.update(future.result())
+        return changed
+
+    def download(self, supplier, filenames, parsers=None):
+        """Download all files for one supplier over a single session. Return {<Filename>: <changed>}."""
+        parsers = parsers or {}
+        changed = {}
+        ftp = None
+        pending = list(filenames)
+        attempts = 0
+        while pending:
+            try:
+                if ftp is None:
+                    ftp = self.connect(supplier)
+                changed[pending[0]] = self.fetch(ftp, supplier, pending[0], parsers.get(pending[0]))
+                pending.pop(0)
+                attempts = 0
+            except ftplib.all_errors as e:
+                attempts += 1
+                self.debug(f"Transfer of '{pending[0]}' interrupted ({e}). Attempt {attempts}/{self._attempts}.")
+                self._close(ftp)
+                ftp = None
+                if attempts >= self._attempts:
+                    raise
+        self._close(ftp)
+        return changed
+
+    def changed(self, supplier, filenames):
+        """Cheaply check over one session which files differ from the cached copies, without downloading them."""
+        ftp = self.connect(supplier)
+        try:
+            return [f for f in filenames if not self.is_current(f, self.stat(ftp, f"{SUPPLIERS[supplier]['dir']}{f}"))]
+        finally:
+            self._close(ftp)
+
+    @staticmethod
+    def connect(supplier):
+        """Open and log in to the FTP server for the given supplier."""
+        env = SUPPLIERS[supplier]['env']
+        tls = os.environ.get(f'FTP_TLS_{env}', '1' if SUPPLIERS[supplier]['tls'] else '0') == '1'
+
+        ftp = FTP_TLS() if tls else FTP()
+        ftp.connect(os.environ[f'FTP_DOMAIN_{env}'], int(os.environ.get(f'FTP_PORT_{env}', 21)))
+        ftp.login(user=os.environ[f'FTP_USERNAME_{env}'], passwd=os.environ[f'FTP_PASSWORD_{env}'])
+        return ftp
+
+    @staticmethod
+    def stat(ftp, path):
+        """Return the remote modification time and size of a file, or None if the server does not report them."""
+        try:
+            ftp.voidcmd('TYPE I')
+            modified = ftp.sendcmd(f'MDTM {path}').split()[-1]
+            size = ftp.size(path)
+        except ftplib.error_perm:
+            return None
+        return {'modified': modified, 'size': size}
+
+    def is_current(self, filename, stat):
+        """Check if the cached copy of a file matches the given remote stat."""
+        meta = self._meta.get(filename)
+        local = os.path.join(self._folder, filename)
+        return bool(stat and meta and meta.get('complete') and meta['modified'] == stat['modified']
+                    and meta['size'] == stat['size'] and os.path.isfile(local)
+                    and os.path.getsize(local) == stat['size'])
+
+    def fetch(self, ftp, supplier, filename, parser=None):
+        """
+        Download a single file unless the cached copy is current. Return True if a new copy was downloaded.
+
+        If a parser is given it receives the data straight from the transfer, so its result is ready as soon as the
+        download completes. Resumed transfers and cached copies are parsed from disk instead.
+        """
+        path = f"{SUPPLIERS[supplier]['dir']}{filename}"
+        stat = self.stat(ftp, path)
+        local = os.path.join(self._folder, filename)
+        if self.is_current(filename, stat):
+            self.debug(f"'{filename}' unchanged. Using cached copy.")
+            if parser:
+                self.refresh(filename, parser)
+            return False
+
+        partial = f'{local}.part'
+        meta = self._meta.get(filename, {})
+        offset = 0
+        if stat and not meta.get('complete', True) and meta.get('modified') == stat['modified'] \
+                and meta.get('size') == stat['size'] and os.path.isfile(partial):
+            offset = os.path.getsize(partial)
+        if stat:
+            self._set_meta(filename, dict(stat, complete=False))
+
+        self.debug(f"Downloading '{filename}' to: {local}" + (f" (resuming at {offset} bytes)" if offset else ""))
+        with open(partial, 'ab' if offset else 'wb') as f:
+            callback = f.write
+            if parser and not offset:
+                parser.reset()
+
+                def callback(data):
+                    f.write(data)
+                    parser.feed(data)
+            ftp.retrbinary(f'RETR {path}', callback, rest=offset or None)
+        os.replace(partial, local)
+
+        if parser:
+            if offset:
+                self.parse(filename, parser)
+            else:
+                parser.close()
+                parser.source = self.version(filename)
+
+        if stat:
+            self._set_meta(filename, dict(stat, complete=True))
+        else:
+            self._set_meta(filename, None)
+        return True
+
+    def parse(self, filename, parser, chunk_size=1 << 20):
+        """Feed a cached file to a parser in fixed-size chunks."""
+        parser.reset()
+        with open(self.path(filename), 'rb') as f:
+            for data in iter(lambda: f.read(chunk_size), b''):
+                parser.feed(data)
+        parser.close()
+        parser.source = self.version(filename)
+        return parser
+
+    def refresh(self, filename, parser):
+        """Parse a cached file unless the parser already holds its current copy, i.e. from the previous pass."""
+        if parser.source != self.version(filename):
+            self.parse(filename, parser)
+        return parser
+
+    def version(self, filename):
+        """Identify the current local copy of a file by its modification time and size."""
+        stat = os.stat(self.path(filename))
+        return stat.st_mtime_ns, stat.st_size
+
+    def path(self, filename):
+        """Return the local path of a cached file."""
+        return os.path.join(self._folder, filename)
+
+    def _set_meta(self, filename, meta):
+        """Update and persist the metadata of a single file."""
+        with self._lock:
+            if meta is None:
+                self._meta.pop(filename, None)
+            else:
+                self._meta[filename] = meta
+            tmp = os.path.join(self._folder, f'{self._meta_file}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self._meta, f)
+            os.replace(tmp, os.path.join(self._folder, self._meta_file))
+
+    def _load_meta(self):
+        """Load cached file metadata."""
+        try:
+            with open(os.path.join(self._folder, self._meta_file)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _close(ftp):
+        """Close an FTP session, ignoring errors from an already broken connection."""
+        if ftp is None:
+            return
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    def debug(self, msg):
+        """Forward debug messages to the owner."""
+        if self._debug:
+            self._debug(msg)
+
+
+class StreamParser:
+    """
+    Incremental delimited-file parser that is fed raw bytes and keeps only the requested columns.
+
+    Records are handed to `row` as {<Column>: <Value>} as soon as they are complete, so the file is never held in
+    memory as a whole. Quoted fields containing newlines are supported. `source` identifies the local copy the parser
+    last parsed completely (see `FeedCache.version`), or is None.
+    """
+
+    def __init__(self, columns, delimiter=',', encoding='utf-8-sig'):
+        self._columns = columns
+        self._delimiter = delimiter
+        self._encoding = encoding
+        self.reset()
+
+    def reset(self):
+        """Forget any partially parsed data."""
+        self._decoder = codecs.getincrementaldecoder(self._encoding)(errors='replace')
+        self._buffer = ''
+        self._record = ''
+        self._positions = None
+        self.source = None
+
+    def feed(self, data):
+        """Parse the complete lines in a chunk of bytes."""
+        self._buffer += self._decoder.decode(data)
+        lines = self._buffer.split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._line(line + '\n')
+
+    def close(self):
+        """Parse whatever is left once the stream has ended."""
+        self._buffer += self._decoder.decode(b'', final=True)
+        if self._buffer:
+            self._line(self._buffer)
+        if self._record:
+            self._parse(self._record)
+        self._buffer = ''
+        self._record = ''
+
+    def _line(self, line):
+        """Collect lines until the quotes in a record are balanced."""
+        self._record += line
+        if self._record.count('"') % 2 == 0:
+            self._parse(self._record)
+            self._record = ''
+
+    def _parse(self, record):
+        """Split a complete record and pass the requested columns on."""
+        values = next(csv.reader([record.rstrip('\r\n')], delimiter=self._delimiter), None)
+        if not values:
+            return
+        if self._positions is None:
+            header = [v.strip() for v in values]
+            self._positions = {c: header.index(c) for c in self._columns if c in header}
+            missing = [c for c in self._columns if c not in self._positions]
+            if missing:
+                raise ValueError(f"Missing columns: {', '.join(missing)}")
+            return
+        self.row({c: values[i] if i < len(values) else '' for c, i in self._positions.items()})
+
+    def row(self, row):
+        """Handle a parsed record."""
+        raise NotImplementedError
+
+
+class QuantityIndex(StreamParser):
+    """
+    Build {<Item Number>: <Quantity>} from an inventory feed while it downloads.
+
+    The optional `subtract` column (i.e. DROP SHIP) is taken off the quantity of every item. With `keep`, only the
+    items in that set are indexed.
+    """
+
+    def __init__(self, item, quantity, subtract=None, delimiter=',', keep=None):
+        self._item = item
+        self._quantity = quantity
+        self._subtract = subtract
+        self._keep = keep
+        self.quantities = {}
+        super().__init__([c for c in (item, quantity, subtract) if c], delimiter)
+
+    def reset(self):
+        """Forget any partially parsed data."""
+        super().reset()
+        self.quantities = {}
+
+    def row(self, row):
+        """Store the quantity of the first row seen for each item."""
+        item = row[self._item]
+        if self._keep is not None and item not in self._keep:
+            return
+        if item and item not in self.quantities:
+            quantity = to_int(row[self._quantity])
+            if self._subtract:
+                quantity -= to_int(row[self._subtract])
+            self.quantities[item] = quantity
+
+
+def read_feed(path, columns, categories=(), delimiter=',', select=None, chunksize=None):
+    """
+    Read only the given columns of a feed file.
+
+    Columns listed in `categories` repeat across many rows (i.e. style, color, size, descriptions) and are stored as
+    pandas categoricals, which keeps each distinct value once. The rest are read as strings.
+
+    With `select`, the file is read FEED_CHUNK_ROWS rows at a time (default 50000) and only the rows where
+    select(<Chunk>) is True are kept, so memory follows the selected rows rather than the whole file.
+    """
+    # Imported here so downloading feeds doesn't pay for pandas.
+    import pandas as pd
+
+    if select is None:
+        dtype = {c: 'category' if c in categories else str for c in columns}
+        return pd.read_csv(path, delimiter=delimiter, usecols=columns, dtype=dtype)
+
+    chunksize = int(chunksize or os.environ.get('FEED_CHUNK_ROWS', 50000))
+    reader = pd.read_csv(path, delimiter=delimiter, usecols=columns, dtype=str, chunksize=chunksize)
+    parts = [chunk.loc[select(chunk)] for chunk in reader]
+    if parts:
+        frame = pd.concat(parts)
+    else:
+        frame = pd.read_csv(path, delimiter=delimiter, usecols=columns, dtype=str, nrows=0)
+    return frame.astype({c: 'category' for c in frame.columns if c in categories})
+
+
+def compact(frame):
+    """Drop categories no longer used after filtering, so copies sent to workers only carry the remaining values."""
+    return frame.assign(**{c: frame[c].cat.remove_unused_categories() for c in frame.columns
+                           if frame[c].dtype.name == 'category'})
+
+
+def to_int(value):
+    """Parse a feed quantity, treating blanks and junk as 0."""
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
@@ -1,35 +1,44 @@
 """API integration for syncing inventories from AlphaBroder to Shopify."""
 import os
-from api import API
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime
+from metrics import metrics
 import click
 
 load_dotenv()
-last_run = None
-
-
-def check_should_run():
-    """Check if it is the next day and SanMar should run again."""
-    global last_run
-
-    now = datetime.utcnow() - timedelta(hours=7)
-    if last_run is None or last_run.day != now.day:
-        last_run = now
-        return True
 
 
 @click.command()
 @click.option('--continuous', '-c', is_flag=True, help='Run continuously. Relevant to updating inventory only.')
+@click.option('--min-interval', type=float, default=None,
+              help='Minimum seconds between continuous inventory updates. Defaults to SYNC_MIN_INTERVAL or 600.')
+@click.option('--daemon', is_flag=True, help='Run inventory updates as a long-lived daemon with a local control '
+                                          'endpoint. Implies --inventory.')
+@click.option('--port', type=int, default=None, help='Daemon control port. Defaults to DAEMON_PORT or 8765.')
+@click.option('--worker', is_flag=True, help='Run as one of several inventory workers, each syncing shards leased '
+                                          'through MongoDB. Implies --inventory.')
+@click.option('--shards', type=int, default=None, help='Number of inventory shards. Defaults to SHARD_COUNT or 8.')
+@click.option('--stores', 'fan_out', is_flag=True, help='Sync inventory to every store listed in STORES from one feed '
+                                                       'load. Implies --inventory.')
+@click.option('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this port.')
+@click.option('--profile', is_flag=True, help='Profile each phase (cProfile and tracemalloc) and write the results to '
+                                           'PROFILE_FOLDER (default: profiles).')
 @click.option('--limit', '-l', default=5, help='Limit number of imported products.')
 @click.option('--download', '-d', is_flag=True, help="Download Files.")
 @click.option('--verbose', '-v', is_flag=True, help="Verbose - Show debug statements.")
 @click.option('--existing', '-e', is_flag=True, help="Include existing products and re-import them.")
+@click.option('--changed', is_flag=True, help="Only import styles whose product file rows changed since the last "
+                                             "--changed import, existing products included.")
+@click.option('--resume', is_flag=True, help="Resume an interrupted product import, skipping finished styles.")
+@click.option('--plan', 'plan_folder', default=None,
+              help="Dry run: write the product and/or inventory change plans to this folder instead of applying them.")
+@click.option('--execute', 'plan_file', default=None, help="Apply a plan file written by --plan.")
 @click.option('--products', '-p', is_flag=True, help="Update products.")
 @click.option('--inventory', '-i', is_flag=True, help="Update inventory.")
 @click.option('--sanmar', '-s', is_flag=True, help="SanMar. If flag is not present, AlphaBroder settings will be used. "
                                                    "Relevant to updating products only.")
-def main(continuous, limit, download, verbose, existing, products, inventory, sanmar):
+def main(continuous, min_interval, daemon, port, worker, shards, fan_out, metrics_port, profile, limit, download,
+         verbose, existing, changed, resume, plan_folder, plan_file, products, inventory, sanmar):
     """Integration"""
     # TODO: Use flags instead of .env settings for ONLY_THESE
     # 600
@@ -43,18 +52,46 @@ def main(continuous, limit, download, verbose, existing, products, inventory, sa
     if not os.path.exists(images):
         os.mkdir(images)
 
-    api = API(download, verbose)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    if profile:
+        from profiling import Profiler
+        metrics.profiler = Profiler(os.environ.get('PROFILE_FOLDER', 'profiles'))
+
+    # Modes are imported as needed, so short runs don't pay for the ones they don't use (see sync.py).
+    from api import API
+
+    # Continuous mode relies on the feed cache to detect changes, so files are always downloaded.
+    api = API(download or (inventory and continuous) or daemon or worker, verbose)
+
+    plan_path = None
+    if plan_folder and not os.path.exists(plan_folder):
+        os.mkdir(plan_folder)
 
+    if plan_file:
+        api.execute_plan(plan_file)
     if products:
-        api.update_products(limit=limit, sanmar=sanmar, skip_existing=not existing)
-    if inventory:
+        if plan_folder:
+            plan_path = os.path.join(plan_folder, f"products-{'sanmar' if sanmar else 'alpha'}.json")
+        api.update_products(limit=limit, sanmar=sanmar, skip_existing=not existing, resume=resume,
+                            plan_path=plan_path, changed=changed)
+    if plan_folder and inventory:
+        api.update_inventory(plan_path=os.path.join(plan_folder, 'inventory.json'))
+    elif fan_out:
+        from stores import Store, FanOut
+        if not Store.configured():
+            raise click.UsageError("--stores needs the stores to sync listed in STORES, i.e. STORES=main,outlet.")
+        FanOut(API, Store.configured(), download, verbose).run()
+    elif worker:
+        from shards import ShardWorker
+        ShardWorker(api, count=shards).run()
+    elif daemon:
+        from daemon import SyncDaemon
+        SyncDaemon(api, port=port, min_interval=min_interval).run()
+    elif inventory:
         if continuous:
-            while True:
-                # if check_should_run():
-                #     print(f'<{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}>: Sanmar inventory update.')
-                #     api.update_inventory()
-                print(f'<{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}>: All inventory update.')
-                api.update_inventory()
+            from scheduler import Scheduler
+            Scheduler(api, api.inventory_files(), min_interval=min_interval).run()
 
         else:
             api.update_inventory()
@@ -0,0 +1,317 @@
+"""Per-phase timings, request counts and API cost accounting for sync runs."""
+import os
+import re
+import json
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timedelta
+from threading import Lock, Thread, local
+from time import perf_counter, sleep
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+class Metrics:
+    """
+    Collect metrics for the current run, attributed to the innermost active phase.
+
+    _phases = {<Phase>: {
+        "seconds": <Wall time spent in the phase>,
+        "entries": <Times the phase was entered>,
+        "requests": {<Kind>: <Count>},
+        "graphql_requested_cost": ...,
+        "graphql_actual_cost": ...,
+        "graphql_min_available": <Lowest throttleStatus.currentlyAvailable seen>,
+        "rest_max_used": <Highest X-Shopify-Shop-Api-Call-Limit usage seen>,
+        "rest_limit": ...,
+        "retries": ...,
+        "sleeps": {<Reason>: <Seconds>}
+    }}
+
+    Time spent in a nested phase is also counted in its parents. A phase entered by several threads at once (i.e. a
+    pool working for its caller, see `current`) counts its wall time once, from the first entry to the last exit.
+    """
+    _prefix = 'zach'
+
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self._totals = {}
+        self.last = None
+        self.profiler = None
+        self.start('run')
+
+    def start(self, name):
+        """Begin a new run report."""
+        with self._lock:
+            self._run = name
+            self._started = datetime.now()
+            self._begin = perf_counter()
+            self._phases = {}
+            self._open = {}
+
+    def finish(self, folder=None):
+        """End the run, fold it into the cumulative totals and write the JSON report. Return the report."""
+        report = self.report()
+        with self._lock:
+            for name, phase in report['phases'].items():
+                self._merge(self._totals.setdefault(name, self._empty()), phase)
+            self.last = report
+        if self.profiler:
+            path = self.profiler.dump(self._run)
+            if path:
+                print(f"<{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}>: Profile summary: {path}")
+        write_report(report, self._run, folder, self._started)
+        return report
+
+    def run(self, name):
+        """Decorator reporting every call of the decorated function as its own run."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                self.start(name)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.finish()
+            return wrapper
+        return decorator
+
+    def report(self):
+        """Return the current run as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                'run': self._run,
+                'started': self._started.strftime("%Y-%m-%d %H:%M:%S"),
+                'seconds': round(perf_counter() - self._begin, 3),
+                'phases': json.loads(json.dumps(self._phases))
+            }
+
+    @contextmanager
+    def phase(self, name):
+        """Attribute everything recorded inside the block to the named phase."""
+        stack = self._stack()
+        stack.append(name)
+        with self._lock:
+            self._open.setdefault(name, [0, perf_counter()])[0] += 1
+        profiling = self.profiler.enter(name) if self.profiler else False
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            if profiling:
+                self.profiler.exit(name)
+            stack.pop()
+            with self._lock:
+                phase = self._phase(name)
+                phase['entries'] += 1
+                # Re-entering a phase that is already open, in this thread or another, must not count its time twice.
+                opened = self._open.get(name)
+                if opened is None:
+                    # Opened before the run started.
+                    phase['seconds'] += elapsed
+                else:
+                    opened[0] -= 1
+                    if opened[0] <= 0:
+                        del self._open[name]
+                        phase['seconds'] += perf_counter() - opened[1]
+
+    def current(self):
+        """
+        Innermost phase of the current thread, or 'other'.
+
+        Threads started for a phase (i.e. a ThreadPoolExecutor) have a phase stack of their own, so their tasks enter
+        the phase of the caller to be attributed and profiled with it.
+        """
+        stack = self._stack()
+        return stack[-1] if stack else 'other'
+
+    def count(self, kind, n=1):
+        """Count requests of the given kind."""
+        with self._lock:
+            requests = self._phase()['requests']
+            requests[kind] = requests.get(kind, 0) + n
+
+    def retry(self, n=1):
+        """Count a retried operation."""
+        with self._lock:
+            self._phase()['retries'] += n
+
+    def sleep(self, reason, seconds):
+        """Sleep and record the time against the given reason (i.e. throttle, retry)."""
+        seconds = max(seconds, 0)
+        sleep(seconds)
+        self.slept(reason, seconds)
+
+    def slept(self, reason, seconds):
+        """Record time spent waiting elsewhere."""
+        with self._lock:
+            sleeps = self._phase()['sleeps']
+            sleeps[reason] = sleeps.get(reason, 0) + seconds
+
+    def graphql_cost(self, result):
+        """Record the cost reported in a GraphQL response's extensions."""
+        cost = (result or {}).get('extensions', {}).get('cost')
+        if not cost:
+            return
+        with self._lock:
+            phase = self._phase()
+            phase['graphql_requested_cost'] += cost.get('requestedQueryCost') or 0
+            phase['graphql_actual_cost'] += cost.get('actualQueryCost') or 0
+            available = cost.get('throttleStatus', {}).get('currentlyAvailable')
+            if available is not None:
+                if phase['graphql_min_available'] is None or available < phase['graphql_min_available']:
+                    phase['graphql_min_available'] = available
+
+    def rest_call_limit(self, headers):
+        """Record REST headroom from the X-Shopify-Shop-Api-Call-Limit header (i.e. "32/40")."""
+        value = next((v for key, v in (headers or {}).items() if key.lower() == 'x-shopify-shop-api-call-limit'), None)
+        if not value:
+            return
+        try:
+            used, limit = (int(v) for v in value.split('/'))
+        except ValueError:
+            return
+        with self._lock:
+            phase = self._phase()
+            phase['rest_max_used'] = max(phase['rest_max_used'], used)
+            phase['rest_limit'] = limit
+
+    def merge(self, report):
+        """Merge a report from another process (i.e. a save worker) into the current run."""
+        with self._lock:
+            for name, phase in report.get('phases', {}).items():
+                self._merge(self._phase(name), phase, seconds=False)
+
+    def prometheus(self):
+        """Render cumulative totals and the current run in the Prometheus text format."""
+        with self._lock:
+            totals = json.loads(json.dumps(self._totals))
+            for name, phase in self._phases.items():
+                self._merge(totals.setdefault(name, self._empty()), phase)
+
+        p = self._prefix
+        lines = [
+            f'# TYPE {p}_phase_seconds_total counter', f'# TYPE {p}_requests_total counter',
+            f'# TYPE {p}_graphql_cost_total counter', f'# TYPE {p}_retries_total counter',
+            f'# TYPE {p}_sleep_seconds_total counter', f'# TYPE {p}_graphql_min_available gauge',
+            f'# TYPE {p}_rest_max_used gauge'
+        ]
+        for name, phase in sorted(totals.items()):
+            label = f'phase="{name}"'
+            lines.append(f'{p}_phase_seconds_total{{{label}}} {phase["seconds"]:.3f}')
+            for kind, n in sorted(phase['requests'].items()):
+                lines.append(f'{p}_requests_total{{{label},kind="{kind}"}} {n}')
+            lines.append(f'{p}_graphql_cost_total{{{label},type="requested"}} {phase["graphql_requested_cost"]}')
+            lines.append(f'{p}_graphql_cost_total{{{label},type="actual"}} {phase["graphql_actual_cost"]}')
+            lines.append(f'{p}_retries_total{{{label}}} {phase["retries"]}')
+            for reason, seconds in sorted(phase['sleeps'].items()):
+                lines.append(f'{p}_sleep_seconds_total{{{label},reason="{reason}"}} {seconds:.3f}')
+            if phase['graphql_min_available'] is not None:
+                lines.append(f'{p}_graphql_min_available{{{label}}} {phase["graphql_min_available"]}')
+            if phase['rest_limit']:
+                lines.append(f'{p}_rest_max_used{{{label}}} {phase["rest_max_used"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        """Serve the Prometheus text format at http://127.0.0.1:<port>/metrics in a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Prometheus scrape endpoint."""
+
+            def do_GET(self):
+                """Metrics."""
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                """Silence request logging."""
+
+        server = HTTPServer(('127.0.0.1', port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def _stack(self):
+        """Phase stack of the current thread."""
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _phase(self, name=None):
+        """Return the named phase, or the innermost active one. Caller must hold the lock."""
+        if name is None:
+            stack = self._stack()
+            name = stack[-1] if stack else 'other'
+        if name not in self._phases:
+            self._phases[name] = self._empty()
+        return self._phases[name]
+
+    @staticmethod
+    def _empty():
+        """New phase record."""
+        return {'seconds': 0.0, 'entries': 0, 'requests': {}, 'graphql_requested_cost': 0,
+                'graphql_actual_cost': 0, 'graphql_min_available': None, 'rest_max_used': 0, 'rest_limit': 0,
+                'retries': 0, 'sleeps': {}}
+
+    @staticmethod
+    def _merge(into, phase, seconds=True):
+        """Add one phase record into another."""
+        if seconds:
+            into['seconds'] += phase['seconds']
+            into['entries'] += phase['entries']
+        for kind, n in phase['requests'].items():
+            into['requests'][kind] = into['requests'].get(kind, 0) + n
+        for reason, s in phase['sleeps'].items():
+            into['sleeps'][reason] = into['sleeps'].get(reason, 0) + s
+        into['graphql_requested_cost'] += phase['graphql_requested_cost']
+        into['graphql_actual_cost'] += phase['graphql_actual_cost']
+        into['retries'] += phase['retries']
+        into['rest_max_used'] = max(into['rest_max_used'], phase['rest_max_used'])
+        into['rest_limit'] = max(into['rest_limit'], phase['rest_limit'])
+        if phase['graphql_min_available'] is not None:
+            if into['graphql_min_available'] is None or phase['graphql_min_available'] < into['graphql_min_available']:
+                into['graphql_min_available'] = phase['graphql_min_available']
+
+
+def write_report(data, name, folder=None, moment=None):
+    """
+    Write a JSON report to `<folder>/<name>-<YYYYmmdd-HHMMSS-ffffff>.json`, named after `moment` (default now), and
+    delete all but the newest METRICS_KEEP reports of that name (default 48, 0 to keep them all). The folder is
+    METRICS_FOLDER (default reports, empty to write nothing). Return the path.
+    """
+    folder = folder if folder is not None else os.environ.get('METRICS_FOLDER', 'reports')
+    if not folder:
+        return None
+    os.makedirs(folder, exist_ok=True)
+    moment = moment or datetime.now()
+    while True:
+        # Reports written at the same moment (i.e. by shard workers) each get a name of their own.
+        path = os.path.join(folder, f"{name}-{moment.strftime('%Y%m%d-%H%M%S-%f')}.json")
+        try:
+            with open(path, 'x') as f:
+                json.dump(data, f, indent=4)
+            break
+        except FileExistsError:
+            moment += timedelta(microseconds=1)
+
+    keep = int(os.environ.get('METRICS_KEEP', 48))
+    if keep > 0:
+        pattern = re.compile(rf'{re.escape(name)}-\d{{8}}-\d{{6}}(-\d{{6}})?\.json$')
+        for old in sorted(n for n in os.listdir(folder) if pattern.match(n))[:-keep]:
+            try:
+                os.unlink(os.path.join(folder, old))
+            except OSError:
+                pass
+    return path
+
+
+metrics = Metrics()
@@ -0,0 +1,207 @@
+"""Serializable change plans and their parallel execution against Shopify."""
+import os
+import json
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import shopify
+
+import retry
+from metrics import metrics
+
+
+class Plan:
+    """
+    Complete list of changes to make in Shopify, compiled without writing anything.
+
+    steps = [{"id": <Step number>, "op": <Operation>, ...}]
+
+    Operations:
+        inventory       - {"variant_id", "inventory_item_id", "available": <Quantity when planned>, "target"}
+        price           - {"variant_id", "price"}
+        product_options - {"product_id"}: put Size before Color
+        metafield       - {"product_id", "key", "value", "metafield_id": <Existing metafield or None>}
+
+    `targets` ({<Variant ID>: <Quantity>}) holds every target considered while planning inventory, including
+    variants that needed no change. It is kept in memory only and is not part of the saved plan.
+    """
+    ops = ('product_options', 'price', 'metafield', 'inventory')
+
+    def __init__(self, name, steps=None, created=None):
+        self.name = name
+        self.steps = steps or []
+        self.created = created or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.targets = {}
+        self._lock = Lock()
+
+    def add(self, op, **data):
+        """Append a step."""
+        if op not in self.ops:
+            raise ValueError(f"Unknown plan operation: {op}")
+        with self._lock:
+            step = dict(data, id=len(self.steps), op=op)
+            self.steps.append(step)
+        return step
+
+    def of(self, op):
+        """Steps of one operation."""
+        return [step for step in self.steps if step['op'] == op]
+
+    def summary(self):
+        """Number of steps per operation."""
+        counts = {}
+        for step in self.steps:
+            counts[step['op']] = counts.get(step['op'], 0) + 1
+        return counts
+
+    def save(self, path):
+        """Write the plan as JSON."""
+        with open(path, 'w') as f:
+            json.dump({'name': self.name, 'created': self.created, 'summary': self.summary(), 'steps': self.steps},
+                      f, indent=1)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan written by `save`."""
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['name'], data['steps'], data.get('created'))
+
+
+class Executor:
+    """
+    Apply a plan with as much parallelism as the API allows.
+
+    Inventory steps are sent in batches of 100 adjustments; every batch and every REST step is a task in a pool of
+    PLAN_WORKERS threads (default 4). Rate limits are still handled by `execute_graphql` and shopify_limits, so more
+    workers only help until the store's budget is used up. With refresh=True current inventory is re-read before
+    adjusting, which makes replaying a saved plan safe. REST steps that fail transiently are parked and retried after
+    the rest of the plan (see retry.py), so one failing product does not hold up a worker. Tasks are reported in the
+    phase `run` was called in.
+
+    result = {"done": [<Step ID>, ...], "failed": [{"id": ..., "op": ..., "error": ...}, ...]}
+    """
+    _batch = 100
+
+    def __init__(self, api, workers=None, refresh=False):
+        self._api = api
+        self._workers = int(workers if workers is not None else os.environ.get('PLAN_WORKERS', 4))
+        self._refresh = refresh
+        self._lock = Lock()
+        self._deferred = retry.DeferredQueue()
+        self.result = {'done': [], 'failed': []}
+
+    def run(self, plan):
+        """Execute every step and return the result."""
+        client = self._api.connect_shopify()
+        tasks = []
+        # Options must be fixed before anything else touches the same products, retries included.
+        for step in plan.of('product_options'):
+            self._apply([step], self._product_options)
+        self._retry_deferred()
+        for op, apply in (('price', self._price), ('metafield', self._metafield)):
+            tasks.extend(([step], apply) for step in plan.of(op))
+
+        inventory = plan.of('inventory')
+        if inventory and self._refresh:
+            with metrics.phase('graphql reads'):
+                levels = self._api.inventory_levels(client, [s['variant_id'] for s in inventory])
+            for step in inventory:
+                if step['variant_id'] in levels:
+                    step['available'] = levels[step['variant_id']]['quantity']
+            inventory = [s for s in inventory if s['target'] != s['available']]
+        tasks.extend((batch, lambda steps: self._inventory(client, steps))
+                     for batch in self._api.chunks(inventory, self._batch))
+
+        phase = metrics.current()
+
+        def run_task(task):
+            with metrics.phase(phase):
+                self._apply(*task)
+
+        with ThreadPoolExecutor(max_workers=max(self._workers, 1)) as pool:
+            list(pool.map(run_task, tasks))
+        self._retry_deferred()
+
+        self._api.debug(f"Plan '{plan.name}': {len(self.result['done'])} steps done, "
+                        f"{len(self.result['failed'])} failed.", bool(self.result['failed']))
+        return self.result
+
+    def _retry_deferred(self):
+        """Retry parked tasks once their backoff has passed, until each succeeds or gives up."""
+        while True:
+            parked = self._deferred.next()
+            if parked is None:
+                break
+            (steps, apply), attempt = parked
+            self._apply(steps, apply, attempt)
+
+    def _apply(self, steps, apply, attempt=0):
+        """Run one task and record the outcome of its steps."""
+        try:
+            apply(steps)
+            error = None
+        except retry.Transient as e:
+            with self._lock:
+                if self._deferred.park((steps, apply), e.kind, attempt):
+                    return
+            error = f"{e.error.__class__.__name__}: {e}"
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+            self._api.debug(traceback.format_exc())
+        with self._lock:
+            for step in steps:
+                if error:
+                    self.result['failed'].append(dict(step, error=error))
+                else:
+                    self.result['done'].append(step['id'])
+
+    def _inventory(self, client, steps):
+        """Adjust a batch of inventory levels."""
+        adjustments = [f'{{inventoryItemId: "{s["inventory_item_id"]}", availableDelta: {s["target"] - s["available"]}}}'
+                       for s in steps]
+        result = self._api.update_inventory_items(client, adjustments)
+        errors = (result or {}).get('data', {}).get('inventoryBulkAdjustQuantityAtLocation', {}).get('userErrors')
+        if errors:
+            raise ValueError("; ".join(e['message'] for e in errors))
+
+    @staticmethod
+    def _price(steps):
+        """Update a variant price."""
+        from api import save
+        for step in steps:
+            variant = shopify.Variant({'id': int(step['variant_id'])})
+            variant.price = step['price']
+            if not save(variant, defer=True):
+                raise ValueError(f"Could not save price of variant {step['variant_id']}")
+
+    def _product_options(self, steps):
+        """Swap a product's options so Size comes before Color, and cache the saved product."""
+        for step in steps:
+            product = retry.call(lambda: shopify.Product.find(step['product_id']), defer=True)
+            if len(product.options) > 0 and product.options[0].name == 'Color':
+                for variant in product.variants:
+                    variant.option2, variant.option1 = variant.option1, variant.option2
+                product.options.reverse()
+                retry.call(product.save, defer=True)
+                self._api.product_cache.put(product)
+
+    @staticmethod
+    def _metafield(steps):
+        """Create or update a product metafield."""
+        from api import save
+        for step in steps:
+            data = {'key': step['key'], 'value': step['value'], 'value_type': 'string',
+                    'namespace': 'api_integration'}
+            if step.get('metafield_id'):
+                metafield = shopify.Metafield(dict(data, id=step['metafield_id']),
+                                              prefix_options={'resource': 'products',
+                                                              'resource_id': step['product_id']})
+                if not save(metafield, defer=True):
+                    raise ValueError(f"Could not save metafield {step['metafield_id']}")
+            else:
+                product = shopify.Product({'id': int(step['product_id'])})
+                retry.call(lambda: product.add_metafield(shopify.Metafield(data)), defer=True)
@@ -0,0 +1,57 @@
+"""Persistent cache of Shopify product state, so product imports only fetch products that changed."""
+import os
+from datetime import datetime, timezone
+
+import shopify
+
+from metrics import metrics
+
+
+def instant(value):
+    """
+    Normalize a Shopify timestamp to UTC, i.e. "2020-09-14T14:00:00Z".
+
+    The REST API reports local time with an offset ("2020-09-14T10:00:00-04:00") and GraphQL reports UTC.
+    """
+    if not value:
+        return None
+    moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class ProductCache:
+    """
+    Last known state of Shopify products, one document per product in `db.product_cache`.
+
+    {"_id": <Product ID>, "updated_at": <UTC timestamp>, "product": <Product with its options and variants>}
+
+    An entry is only used while Shopify still reports the same updatedAt for the product, so products changed
+    outside the integration are fetched again. Every save the integration makes is written back. PRODUCT_CACHE=0
+    stops entries being used, but keeps them up to date. With write=False (i.e. for dry runs) entries are only read.
+    """
+
+    def __init__(self, db, write=True):
+        self._cache = db.product_cache
+        self._enabled = os.environ.get('PRODUCT_CACHE', '1') != '0'
+        self._write = write
+
+    def get(self, updated):
+        """Return {<Product ID>: shopify.Product} for the products of {<Product ID>: <updatedAt>} cached as current."""
+        if not self._enabled or not updated:
+            return {}
+        products = {}
+        for doc in self._cache.find({'_id': {'$in': list(updated)}}):
+            if doc['updated_at'] and doc['updated_at'] == instant(updated[doc['_id']]):
+                products[doc['_id']] = shopify.Product(doc['product'])
+        metrics.count('cached products', len(products))
+        return products
+
+    def put(self, product):
+        """Store the state of a product (a shopify.Product or its dict) as just read from or saved to Shopify."""
+        if not self._write:
+            return
+        data = product if isinstance(product, dict) else product.to_dict()
+        self._cache.replace_one({'_id': str(data['id'])},
+                                {'updated_at': instant(data.get('updated_at')), 'product': data}, upsert=True)
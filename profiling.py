@@ -0,0 +1,110 @@
+"""Opt-in CPU and memory profiling of sync phases."""
+import os
+import io
+import sys
+import pstats
+import cProfile
+import tracemalloc
+from datetime import datetime
+from threading import Lock, get_ident
+
+
+class Profiler:
+    """
+    Profile the top-level phases reported through `metrics.phase` with cProfile and tracemalloc.
+
+    Each phase keeps a cProfile.Profile per thread that is enabled whenever the phase is entered, so phases entered many
+    times (i.e. once per product) add up into a single profile. One phase is profiled at a time. Before Python 3.12
+    cProfile only sees the thread that enabled it, so pool threads entering the active phase for their caller (see
+    `metrics.current`) get profiles of their own, which are merged on `dump`. Memory is traced with tracemalloc only during the
+    first entry of each phase, and the allocations still held at its end are reported, so tracing does not slow down
+    the rest of the run.
+
+    On `dump` every phase is written to `<folder>/<run>-<phase>.prof` (load with `python -m pstats` or snakeviz) and a
+    summary of the top hotspots to `<folder>/<run>-summary.txt`.
+    """
+
+    def __init__(self, folder='profiles', top=15, frames=5):
+        self._folder = folder
+        self._top = top
+        self._frames = frames
+        self._profiles = {}
+        self._memory = {}
+        self._snapshots = {}
+        self._active = None
+        self._owner = None
+        self._tracing = False
+        self._lock = Lock()
+        if not os.path.exists(self._folder):
+            os.makedirs(self._folder, exist_ok=True)
+
+    @property
+    def folder(self):
+        """Folder the profiles are written to."""
+        return self._folder
+
+    def enter(self, name):
+        """Start profiling a phase, unless another phase is already being profiled."""
+        with self._lock:
+            if self._active == name and self._owner != get_ident():
+                # A pool thread working for the active phase. From Python 3.12 on the owner's profile sees it already.
+                if sys.version_info < (3, 12):
+                    self._profiles[name].setdefault(get_ident(), cProfile.Profile()).enable()
+                return True
+            if self._active is not None:
+                return False
+            self._active = name
+            self._owner = get_ident()
+            if name not in self._memory and name not in self._snapshots:
+                # Tracing is only started here if nothing else (i.e. a benchmark) is tracing already.
+                self._tracing = not tracemalloc.is_tracing()
+                if self._tracing:
+                    tracemalloc.start(self._frames)
+                self._snapshots[name] = tracemalloc.take_snapshot()
+            self._profiles.setdefault(name, {}).setdefault(get_ident(), cProfile.Profile()).enable()
+            return True
+
+    def exit(self, name):
+        """Stop profiling a phase."""
+        with self._lock:
+            if self._active != name:
+                return
+            if get_ident() in self._profiles[name]:
+                self._profiles[name][get_ident()].disable()
+            if self._owner != get_ident():
+                return
+            self._active = None
+            self._owner = None
+            if name in self._snapshots:
+                before = self._snapshots.pop(name)
+                self._memory[name] = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:self._top]
+                if self._tracing:
+                    tracemalloc.stop()
+                    self._tracing = False
+
+    def dump(self, run):
+        """Write the profiles and hotspot summary of a run, then start over. Return the summary path."""
+        if not self._profiles:
+            return None
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        summary = [f'{run} - {stamp}']
+        for name, profiles in self._profiles.items():
+            slug = name.replace(' ', '-')
+            out = io.StringIO()
+            stats = pstats.Stats(*profiles.values(), stream=out)
+            stats.dump_stats(os.path.join(self._folder, f'{run}-{stamp}-{slug}.prof'))
+            stats.sort_stats('cumulative').print_stats(self._top)
+            summary.append(f'\n=== {name}: CPU (top {self._top} by cumulative time) ===')
+            summary.append(out.getvalue().strip())
+
+            if name in self._memory:
+                summary.append(f'\n=== {name}: memory (top {self._top} allocations) ===')
+                summary.extend(str(stat) for stat in self._memory[name])
+
+        path = os.path.join(self._folder, f'{run}-{stamp}-summary.txt')
+        with open(path, 'w') as f:
+            f.write('\n'.join(summary) + '\n')
+        self._profiles = {}
+        self._memory = {}
+        self._snapshots = {}
+        return path
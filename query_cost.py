@@ -0,0 +1,159 @@
+"""Estimate the requested cost of GraphQL queries locally and size batches to a cost ceiling."""
+import os
+import re
+
+_token = re.compile(r'"(?:\\.|[^"\\])*"|\.\.\.|[A-Za-z_][A-Za-z0-9_]*|-?\d+(?:\.\d+)?|[{}()\[\]:,!$=@]')
+
+MUTATION_COST = 10
+
+# Most IDs Shopify accepts in one nodes(ids:) list, whatever their cost.
+MAX_IDS = 250
+
+
+def ceiling():
+    """Highest requested cost a single query may have (GRAPHQL_COST_CEILING, default Shopify's limit of 1000)."""
+    return int(os.environ.get('GRAPHQL_COST_CEILING', 1000))
+
+
+def estimate(query):
+    """
+    Return the requested cost Shopify will calculate for a query, following its cost rules:
+
+        scalar and enum fields  0
+        object fields           1 + their selection
+        connections             2 + first (or last) * the cost of one node
+        lists fetched by `ids`  1 + len(ids) * (1 + the selection of one element)
+        mutations               10
+    """
+    tokens = _token.findall(query)
+    if not tokens:
+        return 0
+    operation = tokens[0] if tokens[0] in ('query', 'mutation') else 'query'
+    if operation == 'mutation':
+        return MUTATION_COST
+    fields, _ = _selection(tokens, tokens.index('{'))
+    return _cost(fields)
+
+
+def capacity(build, limit=None):
+    """
+    Return how many items fit in one query under the cost ceiling.
+
+    `build(n)` returns the query for n items. Cost is assumed to grow linearly with the number of items, as it does for
+    every list shape the integration uses.
+    """
+    limit = ceiling() if limit is None else limit
+    one, two = estimate(build(1)), estimate(build(2))
+    per_item = two - one
+    if per_item <= 0:
+        return None
+    return max(int((limit - (one - per_item)) // per_item), 1)
+
+
+def pack(groups, size):
+    """Pack [(<Key>, {<ID>: <Value>}), ...] into batches of `size` IDs, splitting a group where a batch fills up."""
+    batch, count = [], 0
+    for key, items in groups:
+        items = list(items.items())
+        while items:
+            part, items = items[:size - count], items[size - count:]
+            batch.append((key, dict(part)))
+            count += len(part)
+            if count == size:
+                yield batch
+                batch, count = [], 0
+    if batch:
+        yield batch
+
+
+def _selection(tokens, i):
+    """Parse the selection set starting at tokens[i] == '{'. Return ([(<Name>, <Args>, <Children>), ...], <Next>)."""
+    fields = []
+    i += 1
+    while tokens[i] != '}':
+        if tokens[i] == '...':
+            # Inline fragment: "... on Type { ... }" adds its fields to the enclosing selection.
+            i += 3 if tokens[i + 1] == 'on' else 2
+            children, i = _selection(tokens, i)
+            fields.extend(children)
+            continue
+        name = tokens[i]
+        i += 1
+        if tokens[i] == ':':
+            name = tokens[i + 1]
+            i += 2
+        args = {}
+        if tokens[i] == '(':
+            args, i = _arguments(tokens, i)
+        children = None
+        if tokens[i] == '{':
+            children, i = _selection(tokens, i)
+        fields.append((name, args, children))
+    return fields, i + 1
+
+
+def _arguments(tokens, i):
+    """Parse an argument list starting at tokens[i] == '('. Return ({<Name>: <Value>}, <Next>)."""
+    args = {}
+    i += 1
+    while tokens[i] != ')':
+        if tokens[i] == ',':
+            i += 1
+            continue
+        name = tokens[i]
+        args[name], i = _value(tokens, i + 2)
+    return args, i + 1
+
+
+def _value(tokens, i):
+    """Parse one argument value. Lists become Python lists, numbers ints and everything else strings."""
+    token = tokens[i]
+    if token == '[':
+        values = []
+        i += 1
+        while tokens[i] != ']':
+            if tokens[i] == ',':
+                i += 1
+                continue
+            value, i = _value(tokens, i)
+            values.append(value)
+        return values, i + 1
+    if token == '{':
+        depth = 1
+        i += 1
+        while depth:
+            depth += {'{': 1, '}': -1}.get(tokens[i], 0)
+            i += 1
+        return token, i
+    if token == '$':
+        return tokens[i + 1], i + 2
+    if re.match(r'-?\d+$', token):
+        return int(token), i + 1
+    return token.strip('"'), i + 1
+
+
+def _cost(fields):
+    """Cost of a selection."""
+    return sum(_field(name, args, children) for name, args, children in fields)
+
+
+def _field(name, args, children):
+    """Cost of one field."""
+    if children is None:
+        return 0
+    size = args.get('first', args.get('last'))
+    if isinstance(size, int):
+        return 2 + size * _node(children)
+    if isinstance(args.get('ids'), list):
+        return 1 + len(args['ids']) * (1 + _cost(children))
+    return 1 + _cost(children)
+
+
+def _node(children):
+    """Cost of one node of a connection (`edges { node }` or `nodes`)."""
+    for name, args, grandchildren in children:
+        if name == 'edges' and grandchildren:
+            return sum(_field(n, a, c) for n, a, c in grandchildren if n == 'node')
+        if name == 'nodes' and grandchildren is not None:
+            return 1 + _cost(grandchildren)
+    return 1
@@ -0,0 +1,165 @@
+"""Retries with jittered exponential backoff, a circuit breaker for outages and a queue for deferred work."""
+import os
+import random
+import socket
+from ssl import SSLError
+from threading import Lock
+from time import monotonic
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+
+from pyactiveresource.connection import Error, ClientError, ServerError
+
+from metrics import metrics
+
+# (<Base delay>, <Maximum delay>) in seconds for each kind of transient error.
+POLICIES = {
+    'throttle': (1, 60),
+    'server': (2, 120),
+    'network': (1, 60)
+}
+
+
+def classify(error):
+    """
+    Return the kind of an error: throttle, server or network, which are worth retrying, or permanent.
+
+    Client errors other than 429 (i.e. 404, 422) and anything unrecognised are permanent.
+    """
+    if isinstance(error, ClientError):
+        response = getattr(error, 'response', None)
+        return 'throttle' if getattr(response, 'code', None) == 429 else 'permanent'
+    if isinstance(error, ServerError):
+        return 'server'
+    if isinstance(error, HTTPError):
+        if error.code == 429:
+            return 'throttle'
+        return 'server' if error.code >= 500 else 'permanent'
+    # pyactiveresource wraps connection failures (URLError) in a plain Error.
+    if type(error) is Error or isinstance(error, (URLError, HTTPException, SSLError, socket.timeout, OSError)):
+        return 'network'
+    return 'permanent'
+
+
+def backoff(kind, attempt):
+    """Seconds to wait before retry number `attempt` (from 0), with full jitter."""
+    base, cap = POLICIES.get(kind, POLICIES['server'])
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Transient(Exception):
+    """Raised instead of waiting when an operation failed transiently and the caller can defer it."""
+
+    def __init__(self, kind, error):
+        super().__init__(f"{kind}: {error}")
+        self.kind = kind
+        self.error = error
+
+
+class CircuitBreaker:
+    """
+    Stop calling Shopify during a sustained outage.
+
+    After RETRY_BREAKER_FAILURES (default 5) transient failures in a row the breaker opens and `wait` holds every
+    caller for RETRY_BREAKER_COOLDOWN seconds (default 60). The next call then probes the API: a success closes the
+    breaker, a failure opens it again.
+    """
+
+    def __init__(self, failures=None, cooldown=None):
+        self._failures = int(failures if failures is not None else os.environ.get('RETRY_BREAKER_FAILURES', 5))
+        self._cooldown = float(cooldown if cooldown is not None else os.environ.get('RETRY_BREAKER_COOLDOWN', 60))
+        self._lock = Lock()
+        self._count = 0
+        self._opened = None
+
+    @property
+    def open(self):
+        """Whether calls are currently held back."""
+        with self._lock:
+            return self._opened is not None and monotonic() - self._opened < self._cooldown
+
+    def wait(self):
+        """Block while the breaker is open."""
+        with self._lock:
+            remaining = self._cooldown - (monotonic() - self._opened) if self._opened is not None else 0
+        if remaining > 0:
+            metrics.sleep('breaker', remaining)
+
+    def success(self):
+        """Record a successful call."""
+        with self._lock:
+            self._count = 0
+            self._opened = None
+
+    def failure(self):
+        """Record a transient failure."""
+        with self._lock:
+            self._count += 1
+            if self._count >= self._failures:
+                self._opened = monotonic()
+
+
+breaker = CircuitBreaker()
+
+
+def call(func, attempts=None, defer=False):
+    """
+    Call func(), retrying transient errors with backoff up to RETRY_ATTEMPTS times (default 4).
+
+    Permanent errors are raised at once. With defer=True the first transient error raises `Transient` instead of
+    waiting, so the caller can park the work and move on.
+    """
+    attempts = int(attempts if attempts is not None else os.environ.get('RETRY_ATTEMPTS', 4))
+    attempt = 0
+    while True:
+        breaker.wait()
+        try:
+            result = func()
+        except Exception as e:
+            kind = classify(e)
+            if kind == 'permanent':
+                raise
+            if kind != 'throttle':
+                breaker.failure()
+            if defer:
+                raise Transient(kind, e)
+            attempt += 1
+            if attempt >= attempts:
+                raise
+            metrics.retry()
+            metrics.sleep(kind, backoff(kind, attempt))
+            continue
+        breaker.success()
+        return result
+
+
+class DeferredQueue:
+    """
+    Work parked after a transient failure, retried once its backoff has passed.
+
+    Items are retried at most RETRY_ATTEMPTS times (default 4) before `park` reports them as given up.
+    """
+
+    def __init__(self, attempts=None):
+        self._attempts = int(attempts if attempts is not None else os.environ.get('RETRY_ATTEMPTS', 4))
+        self._items = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def park(self, item, kind, attempt=0):
+        """Park an item. Return False if it has used up its attempts."""
+        if attempt + 1 >= self._attempts:
+            return False
+        self._items.append((monotonic() + backoff(kind, attempt + 1), attempt + 1, item))
+        return True
+
+    def next(self):
+        """Wait for the earliest parked item and return (<Item>, <Attempt>), or None if the queue is empty."""
+        if not self._items:
+            return None
+        self._items.sort(key=lambda entry: entry[0])
+        due, attempt, item = self._items.pop(0)
+        if due > monotonic():
+            metrics.sleep('deferred', due - monotonic())
+        return item, attempt
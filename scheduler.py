@@ -0,0 +1,123 @@
+"""Change-driven scheduling for continuous inventory updates."""
+import os
+from time import monotonic
+from threading import Event
+import ftplib
+
+
+class Scheduler:
+    """
+    Poll the supplier feeds for changes and run an inventory update only when a feed has been updated.
+
+    Each supplier is polled on its own cadence. Failed polls and failed updates back off exponentially up to
+    `max_backoff` seconds, and updates never start less than `min_interval` seconds apart.
+
+    _suppliers = {<Supplier>: {
+        "files": [<Filename>, ...],
+        "interval": <Seconds between polls>,
+        "next": <Monotonic time of the next poll>,
+        "failures": <Consecutive failed polls>
+    }}
+    """
+
+    def __init__(self, api, files, min_interval=None, max_backoff=None, sync=None):
+        self._api = api
+        self._sync = sync or api.update_inventory
+        self._min_interval = float(min_interval if min_interval is not None
+                                   else os.environ.get('SYNC_MIN_INTERVAL', 600))
+        self._max_backoff = float(max_backoff if max_backoff is not None
+                                  else os.environ.get('POLL_MAX_BACKOFF', 3600))
+        defaults = {'alpha': 300, 'sanmar': 3600}
+        self._suppliers = {
+            supplier: {
+                'files': filenames,
+                'interval': float(os.environ.get(f'POLL_INTERVAL_{supplier.upper()}', defaults.get(supplier, 300))),
+                'next': 0,
+                'failures': 0
+            } for supplier, filenames in files.items()
+        }
+        self._pending = True
+        self._last_sync = None
+        self._sync_failures = 0
+        self._next_sync = 0
+        self._forced = False
+        self._stopped = False
+        self._wake = Event()
+
+    def run(self, passes=None):
+        """Poll and update until stopped, or for the given number of updates."""
+        while not self._stopped and (passes is None or passes > 0):
+            if self.step():
+                passes = passes - 1 if passes is not None else None
+            self._wake.wait(max(self.next_wake() - monotonic(), 0))
+            self._wake.clear()
+
+    def request(self):
+        """Run an update as soon as possible, regardless of feed changes and the minimum interval."""
+        self._pending = True
+        self._forced = True
+        self._next_sync = 0
+        self._wake.set()
+
+    def stop(self):
+        """Stop after the current update."""
+        self._stopped = True
+        self._wake.set()
+
+    def step(self):
+        """Poll every supplier that is due and run an update if anything changed. Return True if an update ran."""
+        now = monotonic()
+        for supplier, state in self._suppliers.items():
+            if state['next'] <= now:
+                self.poll(supplier, state)
+
+        if not self._pending or now < self._next_sync:
+            return False
+        if not self._forced and self._last_sync is not None and now - self._last_sync < self._min_interval:
+            self._next_sync = self._last_sync + self._min_interval
+            return False
+
+        self._api.debug("Update requested." if self._forced else "Feed change detected. Updating inventory.", True)
+        self._last_sync = monotonic()
+        self._forced = False
+        try:
+            self._sync()
+        except Exception as e:
+            self._sync_failures += 1
+            delay = self.backoff(self._min_interval, self._sync_failures)
+            self._next_sync = monotonic() + delay
+            self._api.debug(f"Inventory update failed ({e}). Retrying in {int(delay)}s.", True)
+            return True
+        self._pending = False
+        self._sync_failures = 0
+        return True
+
+    def poll(self, supplier, state):
+        """Check one supplier for changed files, backing off if the server can't be reached."""
+        try:
+            changed = self._api.feeds.changed(supplier, state['files'])
+        except ftplib.all_errors as e:
+            state['failures'] += 1
+            delay = self.backoff(state['interval'], state['failures'])
+            state['next'] = monotonic() + delay
+            self._api.debug(f"Could not poll {supplier} ({e}). Retrying in {int(delay)}s.", True)
+            return
+
+        state['failures'] = 0
+        state['next'] = monotonic() + state['interval']
+        if changed:
+            self._api.debug(f"{supplier}: {', '.join(changed)} changed.")
+            self._pending = True
+
+    def backoff(self, base, failures):
+        """Exponential backoff capped at max_backoff."""
+        return min(base * 2 ** (failures - 1), self._max_backoff)
+
+    def next_wake(self):
+        """Return the monotonic time at which something is next due."""
+        wake = min(state['next'] for state in self._suppliers.values())
+        if self._forced:
+            return monotonic()
+        if self._pending:
+            wake = min(wake, max(self._next_sync, (self._last_sync or 0) + self._min_interval))
+        return wake
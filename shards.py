@@ -0,0 +1,218 @@
+"""Sharded inventory sync across several worker processes or hosts coordinated through MongoDB."""
+import os
+import socket
+import zlib
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from time import sleep, monotonic
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from metrics import metrics
+
+
+def shard_of(pid, count):
+    """Stable shard number of a product."""
+    return zlib.crc32(str(pid).encode('utf-8')) % count
+
+
+def worker_id():
+    """Identifier of this worker process."""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class Leases:
+    """
+    Time-limited leases on inventory shards, one document per shard in `db.leases`.
+
+    {"_id": "inventory-<n>", "owner": <Worker>, "expires": <datetime>, "completed": <datetime of last full sync>}
+
+    A shard can be taken when its lease has expired (so a crashed worker's shard is reclaimed after `ttl` seconds)
+    and it has not been completed within the last `interval` seconds.
+    """
+
+    def __init__(self, db, count, owner=None, ttl=300, interval=0):
+        self._leases = db.leases
+        self._count = count
+        self._owner = owner or worker_id()
+        self._ttl = ttl
+        self._interval = interval
+
+    @property
+    def owner(self):
+        """This worker's ID."""
+        return self._owner
+
+    def acquire(self):
+        """Take the first available shard. Return its number, or None if all are leased or recently completed."""
+        now = datetime.utcnow()
+        for shard in range(self._count):
+            try:
+                lease = self._leases.find_one_and_update(
+                    {'_id': self.key(shard),
+                     '$and': [{'$or': [{'expires': {'$lt': now}}, {'owner': self._owner}]},
+                              {'$or': [{'completed': {'$lt': now - timedelta(seconds=self._interval)}},
+                                       {'completed': None}]}]},
+                    {'$set': {'owner': self._owner, 'expires': now + timedelta(seconds=self._ttl)}},
+                    upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # The shard exists and is held by someone else or was completed recently.
+                continue
+            if lease and lease['owner'] == self._owner:
+                return shard
+        return None
+
+    def renew(self, shard):
+        """Extend a held lease. Return False if it was lost to another worker."""
+        result = self._leases.update_one({'_id': self.key(shard), 'owner': self._owner},
+                                         {'$set': {'expires': datetime.utcnow() + timedelta(seconds=self._ttl)}})
+        return result.matched_count == 1
+
+    def complete(self, shard):
+        """Mark a shard as synced and release it."""
+        now = datetime.utcnow()
+        self._leases.update_one({'_id': self.key(shard), 'owner': self._owner},
+                                {'$set': {'expires': now, 'completed': now}})
+
+    def release(self, shard):
+        """Release a shard without marking it as synced."""
+        self._leases.update_one({'_id': self.key(shard), 'owner': self._owner},
+                                {'$set': {'expires': datetime.utcnow()}})
+
+    @staticmethod
+    def key(shard):
+        """Lease document ID of a shard."""
+        return f'inventory-{shard}'
+
+
+class SharedBudget:
+    """
+    Store-wide GraphQL cost budget shared by all workers, kept as a leaky bucket in `db.budget`.
+
+    {"_id": "graphql", "available": <Points>, "updated": <datetime>}
+
+    Workers take the requested cost of a query before sending it and correct the bucket with the throttle status
+    Shopify reports back, so the combined request rate stays within the store's limit.
+    """
+
+    def __init__(self, db, maximum=None, restore_rate=None, key='graphql'):
+        self._budget = db.budget
+        self._key = key
+        self._maximum = float(maximum if maximum is not None else os.environ.get('GRAPHQL_BUDGET_MAX', 1000))
+        self._restore_rate = float(restore_rate if restore_rate is not None
+                                   else os.environ.get('GRAPHQL_BUDGET_RATE', 50))
+
+    def take(self, cost):
+        """Wait until `cost` points are available and take them."""
+        cost = min(cost, self._maximum)
+        while True:
+            now = datetime.utcnow()
+            state = self._budget.find_one({'_id': self._key})
+            if state is None:
+                try:
+                    self._budget.insert_one({'_id': self._key, 'available': self._maximum, 'updated': now})
+                except DuplicateKeyError:
+                    pass
+                continue
+            elapsed = max((now - state['updated']).total_seconds(), 0)
+            available = min(self._maximum, state['available'] + elapsed * self._restore_rate)
+            if available < cost:
+                metrics.sleep('budget', (cost - available) / self._restore_rate)
+                continue
+            # Compare-and-set on the last update so concurrent workers never spend the same points.
+            result = self._budget.update_one({'_id': self._key, 'updated': state['updated']},
+                                             {'$set': {'available': available - cost, 'updated': now}})
+            if result.modified_count == 1:
+                return
+
+    def observe(self, result):
+        """Lower the shared bucket to what Shopify reports as currently available."""
+        cost = (result or {}).get('extensions', {}).get('cost')
+        if not cost:
+            return
+        reported = cost.get('throttleStatus', {}).get('currentlyAvailable')
+        if reported is not None:
+            self._budget.update_one({'_id': self._key, 'available': {'$gt': reported}},
+                                    {'$set': {'available': reported, 'updated': datetime.utcnow()}})
+
+
+class ShardWorker:
+    """
+    Take inventory shards one at a time and sync them until stopped.
+
+    The feeds are parsed once and the quantities shared by every shard synced within `interval` seconds, so a round
+    over all shards costs one feed load. They are loaded again sooner if the mapping changed. A heartbeat thread renews
+    the lease every third of its TTL while a shard is being synced. If the lease is lost the pass stops before its next
+    batch, leaving the shard to its new owner.
+    """
+
+    def __init__(self, api, count=None, ttl=None, interval=None, poll=30):
+        self._api = api
+        self._count = int(count if count is not None else os.environ.get('SHARD_COUNT', 8))
+        ttl = int(ttl if ttl is not None else os.environ.get('SHARD_LEASE_TTL', 300))
+        interval = int(interval if interval is not None else os.environ.get('SHARD_INTERVAL', 600))
+        db = api.init_mongodb()
+        self._leases = Leases(db, self._count, ttl=ttl, interval=interval)
+        self._ttl = ttl
+        self._interval = interval
+        self._poll = poll
+        self._stopped = Event()
+        self._quantities = None
+        self._version = None
+        self._loaded = None
+        api.budget = SharedBudget(db)
+
+    def run(self, passes=None):
+        """Sync shards until stopped, or for the given number of shards."""
+        while not self._stopped.is_set() and (passes is None or passes > 0):
+            shard = self._leases.acquire()
+            if shard is None:
+                sleep(self._poll)
+                continue
+            self._api.debug(f"{self._leases.owner}: syncing shard {shard + 1}/{self._count}.", True)
+            if self.sync(shard):
+                passes = passes - 1 if passes is not None else None
+
+    def sync(self, shard):
+        """Sync one shard while keeping its lease alive."""
+        done = Event()
+        lost = Event()
+        heartbeat = Thread(target=self._heartbeat, args=(shard, done, lost), daemon=True)
+        heartbeat.start()
+        try:
+            self._api.update_inventory(shard=(shard, self._count), quantities=self.quantities(), stop=lost)
+        except Exception as e:
+            if lost.is_set():
+                self._api.debug(f"Stopped syncing shard {shard}: its lease was lost.", True)
+            else:
+                self._api.debug(f"Shard {shard} failed: {e}", True)
+                self._leases.release(shard)
+            return False
+        finally:
+            done.set()
+            heartbeat.join()
+        self._leases.complete(shard)
+        return True
+
+    def quantities(self):
+        """Supplier quantities for the next shard, loaded again once `interval` has passed or the mapping changed."""
+        self._api.load_mapping()
+        if self._quantities is None or self._version != self._api.mapping_version \
+                or monotonic() - self._loaded >= self._interval:
+            self._quantities = self._api.prepare_inventory(False)
+            self._version = self._api.mapping_version
+            self._loaded = monotonic()
+        return self._quantities
+
+    def stop(self):
+        """Stop after the current shard."""
+        self._stopped.set()
+
+    def _heartbeat(self, shard, done, lost):
+        """Renew the lease until the shard is done. Set `lost` if another worker took it over."""
+        while not done.wait(self._ttl / 3):
+            if not self._leases.renew(shard):
+                self._api.debug(f"Lost the lease on shard {shard}.", True)
+                lost.set()
+                return
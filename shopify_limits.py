@@ -1,8 +1,7 @@
 """Add rate limiting to ShopifyConnection."""
-import time
-
 import pyactiveresource.connection
 from shopify.base import ShopifyConnection
+from metrics import metrics
 import sys
 
 
@@ -11,25 +10,31 @@ def patch_shopify_with_limits():
     func = ShopifyConnection._open
 
     def patched_open(self, *args, **kwargs):
-        """Add limits."""
+        """
+        Add limits.
+
+        Throttled requests (429) are repeated after Shopify's Retry-After. Other errors are raised at once, to be
+        retried or deferred by the caller (see retry.py), so each request has a single retry layer.
+        """
         error = None
         for _ in range(8):
-            error = None
             try:
-                return func(self, *args, **kwargs)
+                metrics.count('rest')
+                response = func(self, *args, **kwargs)
+                metrics.rest_call_limit(getattr(response, 'headers', None))
+                return response
 
             except pyactiveresource.connection.ClientError as e:
                 error = e
                 if e.response.code == 429:
                     retry_after = float(e.response.headers.get('Retry-After', 8))
-                    time.sleep(retry_after)
+                    metrics.sleep('throttle', retry_after)
                 else:
                     print(e, file=sys.stderr)
                     raise e
             except pyactiveresource.connection.ServerError as e:
-                error = e
                 print(e, file=sys.stderr)
-                time.sleep(60)
+                raise e
 
         if error:
             raise ValueError("Could not complete request: {}.".format(error))
@@ -0,0 +1,72 @@
+"""Fingerprints of the product feed as of the last import, for importing only what changed."""
+import os
+import gzip
+import json
+
+
+class Snapshot:
+    """
+    Per-item fingerprints of the product feed rows that were last imported.
+
+    {<Item Number>: [<Style>, <Digest of the row's imported columns and price>]}
+
+    Stored as gzipped JSON in `<folder>/<name>.json.gz`, replaced atomically on save.
+    """
+
+    def __init__(self, name, folder='snapshots'):
+        self._folder = folder
+        self._path = os.path.join(folder, f'{name}.json.gz')
+
+    @property
+    def path(self):
+        """Location of the snapshot file."""
+        return self._path
+
+    def load(self):
+        """Return the stored fingerprints, or {} if there is no snapshot yet."""
+        if not os.path.isfile(self._path):
+            return {}
+        with gzip.open(self._path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def diff(self, items):
+        """
+        Compare current fingerprints {<Item Number>: [<Style>, <Digest>]} with the snapshot.
+
+        changes = {"new": [<Item Number>, ...], "changed": [...], "removed": [...], "styles": {<Affected style>, ...}}
+        """
+        previous = self.load()
+        changes = {'new': [], 'changed': [], 'removed': [], 'styles': set()}
+        for item, (style, digest) in items.items():
+            if item not in previous:
+                changes['new'].append(item)
+            elif previous[item][1] != digest or previous[item][0] != style:
+                changes['changed'].append(item)
+                changes['styles'].add(previous[item][0])
+            else:
+                continue
+            changes['styles'].add(style)
+        for item, (style, _) in previous.items():
+            if item not in items:
+                changes['removed'].append(item)
+                changes['styles'].add(style)
+        return changes
+
+    def save(self, items, removed=()):
+        """
+        Record the fingerprints of the items that were imported and forget the items removed from the feed.
+
+        Every other item keeps its previous fingerprint, or stays unrecorded, so items left out of an import (i.e. by
+        a limit) are still found as new or changed next time.
+        """
+        current = self.load()
+        for item in removed:
+            current.pop(item, None)
+        current.update(items)
+        if not os.path.exists(self._folder):
+            os.makedirs(self._folder, exist_ok=True)
+        tmp = f'{self._path}.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump(current, f)
+        os.replace(tmp, self._path)
+        return len(current)
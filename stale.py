@@ -0,0 +1,59 @@
+"""Detect mapped variants that no longer exist in Shopify so they can be pruned from the mapping."""
+import os
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+
+class StaleMappings:
+    """
+    Mapped variants Shopify returned nothing for, counted across inventory passes in `db.stale`.
+
+    {"_id": <Variant ID>, "product_id": <Product ID>, "misses": <Passes in a row>, "first": <datetime>, "last": ...}
+
+    A variant that is read again is forgotten. After STALE_CONFIRM_PASSES misses in a row (default 3, 0 to never
+    confirm) it is confirmed as deleted and can be pruned from the mapping.
+    """
+
+    def __init__(self, db, passes=None):
+        self._stale = db.stale
+        self._passes = int(passes if passes is not None else os.environ.get('STALE_CONFIRM_PASSES', 3))
+        self._pending = None
+
+    @property
+    def enabled(self):
+        """Whether stale variants are ever confirmed."""
+        return self._passes > 0
+
+    def record(self, missing, seen):
+        """Count a miss for {<Variant ID>: <Product ID>} and forget the variants in `seen` that were missing before."""
+        if self._pending is None:
+            self._pending = set(self._stale.distinct('_id'))
+        now = datetime.utcnow()
+        requests = [UpdateOne({'_id': vid}, {'$inc': {'misses': 1}, '$set': {'product_id': pid, 'last': now},
+                                             '$setOnInsert': {'first': now}}, upsert=True)
+                    for vid, pid in missing.items()]
+        found = [vid for vid in seen if vid in self._pending]
+        if requests:
+            self._stale.bulk_write(requests, ordered=False)
+            self._pending.update(missing)
+        if found:
+            self._stale.delete_many({'_id': {'$in': found}})
+            self._pending.difference_update(found)
+
+    def confirmed(self):
+        """Return {<Product ID>: [<Variant ID>, ...]} of the variants missing for enough passes in a row."""
+        if not self.enabled:
+            return {}
+        products = {}
+        for doc in self._stale.find({'misses': {'$gte': self._passes}}, {'product_id': 1}):
+            products.setdefault(doc['product_id'], []).append(doc['_id'])
+        return products
+
+    def forget(self, vids):
+        """Stop tracking the given variants, i.e. once they have been pruned."""
+        vids = list(vids)
+        self._stale.delete_many({'_id': {'$in': vids}})
+        if self._pending is not None:
+            self._pending.difference_update(vids)
+
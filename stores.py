@@ -0,0 +1,132 @@
+"""Per-store Shopify settings, and syncing one supplier inventory to several stores from a single feed load."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import pymongo
+
+from metrics import metrics
+from shards import SharedBudget
+
+# One MongoDB client per URL and process, as clients pool connections and must not be shared across a fork.
+_clients = {}
+_clients_lock = Lock()
+
+
+def mongo_client(url):
+    """Shared MongoDB client of this process for a URL."""
+    key = (os.getpid(), url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = pymongo.MongoClient(url)
+        return _clients[key]
+
+
+class Store:
+    """
+    Connection settings of one Shopify store.
+
+    The default store (no name) reads SHOPIFY_API_KEY, SHOPIFY_PASSWORD, SHOPIFY_STORE (or SHOPIFY_URL),
+    SHOPIFY_LOCATION and MONGODB_URL as always. A named store reads the same settings prefixed with
+    `STORE_<NAME>_`, plus MONGODB_DATABASE for its mapping (default: the store name). MONGODB_URL,
+    GRAPHQL_BUDGET_MAX and GRAPHQL_BUDGET_RATE fall back to the unprefixed values.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+    @classmethod
+    def configured(cls):
+        """The stores listed in STORES (i.e. "main,outlet")."""
+        return [cls(name.strip()) for name in os.environ.get('STORES', '').split(',') if name.strip()]
+
+    def setting(self, key, default=None, shared=False):
+        """Read a setting of this store. Shared settings fall back to the unprefixed variable."""
+        value = None
+        if self.name:
+            value = os.environ.get(f'STORE_{self.name.upper()}_{key}')
+        if value is None and (shared or not self.name):
+            value = os.environ.get(key)
+        if value is None:
+            if default is None:
+                raise KeyError(f'STORE_{self.name.upper()}_{key}' if self.name else key)
+            return default
+        return value
+
+    @property
+    def url(self):
+        """Admin API URL of the store. SHOPIFY_URL overrides it (i.e. for a local server)."""
+        if self.setting('SHOPIFY_URL', ''):
+            return self.setting('SHOPIFY_URL')
+        return "https://{}:{}@{}.myshopify.com/admin/api/2020-07".format(self.setting('SHOPIFY_API_KEY'),
+                                                                        self.setting('SHOPIFY_PASSWORD'),
+                                                                        self.setting('SHOPIFY_STORE'))
+
+    @property
+    def location(self):
+        """ID of the location inventory is adjusted at."""
+        return self.setting('SHOPIFY_LOCATION')
+
+    def database(self):
+        """MongoDB database holding this store's mapping, on the process' shared client for its URL."""
+        client = mongo_client(self.setting('MONGODB_URL', shared=True))
+        return client[self.setting('MONGODB_DATABASE', self.name or 'bulkthreads')]
+
+    def budget(self, db):
+        """GraphQL cost budget of this store, shared by everything syncing it."""
+        return SharedBudget(db, self.setting('GRAPHQL_BUDGET_MAX', 1000, shared=True),
+                            self.setting('GRAPHQL_BUDGET_RATE', 50, shared=True))
+
+
+class FanOut:
+    """
+    Sync the same supplier inventory to several stores.
+
+    The feeds are downloaded and indexed once. Every store then syncs in its own thread with its own API instance:
+    Shopify resources are thread-local, so each thread points them at its own store, and each store loads its own
+    mapping and spends its own rate budget.
+    """
+
+    def __init__(self, api_class, stores, download=False, debug=False):
+        if not stores:
+            raise ValueError("No stores to sync. List them in STORES, i.e. STORES=main,outlet.")
+        self._api_class = api_class
+        self._stores = stores
+        self._download = download
+        self._debug = debug
+        self._apis = {}
+
+    def api(self, store):
+        """The API instance of a store, kept between passes."""
+        if store.name not in self._apis:
+            api = self._api_class(False, self._debug, store=store)
+            api.budget = store.budget(api.init_mongodb())
+            self._apis[store.name] = api
+        return self._apis[store.name]
+
+    @metrics.run('fan-out')
+    def run(self, alpha_only=False, full=True):
+        """Run one inventory pass for every store. Return {<Store>: <Result>}, with {"error": ...} for failed stores."""
+        feeds = self._api_class(self._download, self._debug)
+        with metrics.phase('feeds'):
+            quantities = feeds.prepare_inventory(alpha_only)
+
+        with ThreadPoolExecutor(max_workers=max(len(self._stores), 1)) as pool:
+            futures = {store.name: pool.submit(self.sync, store, quantities, alpha_only, full)
+                       for store in self._stores}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                feeds.debug(f"Store '{name}' failed: {e}", True)
+                results[name] = {'error': str(e)}
+                continue
+            feeds.debug(f"Store '{name}': {len(results[name]['done'])} adjusted, "
+                        f"{len(results[name]['failed'])} failed.", True)
+        return results
+
+    def sync(self, store, quantities, alpha_only, full):
+        """Sync one store from the shared quantities."""
+        with metrics.phase(f'store {store.name}'):
+            return self.api(store).sync_inventory(alpha_only, full, quantities=quantities)
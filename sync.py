@@ -0,0 +1,81 @@
+"""
+Fast-start inventory sync for short, frequent runs (i.e. from cron).
+
+    $ python sync.py -d
+
+Only the inventory pass is loaded. The API module, and with it pandas, pymongo and shopify, is imported in the
+background while the feeds download, so start-up overlaps the transfer instead of preceding it. Product imports and
+the other modes stay in integration.py.
+"""
+import os
+import importlib
+from datetime import datetime
+from threading import Thread
+import click
+from dotenv import load_dotenv
+
+
+class Preload(Thread):
+    """Import a module in a background thread."""
+
+    def __init__(self, name):
+        super().__init__(daemon=True)
+        self._name = name
+        self._module = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        """Import the module, keeping any error for `module`."""
+        try:
+            self._module = importlib.import_module(self._name)
+        except BaseException as e:
+            self._error = e
+
+    def module(self):
+        """Wait for the import and return the module."""
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._module
+
+
+def log(message):
+    """Timestamped progress line."""
+    print(f'<{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}>: {message}')
+
+
+@click.command()
+@click.option('--download', '-d', is_flag=True, help="Download changed feed files first.")
+@click.option('--verbose', '-v', is_flag=True, help="Verbose - Show debug statements.")
+@click.option('--alpha-only', '-a', is_flag=True, help="Only sync AlphaBroder inventory.")
+@click.option('--plan', 'plan_folder', default=None, help="Dry run: write the inventory plan to this folder.")
+def main(download, verbose, alpha_only, plan_folder):
+    """Inventory sync"""
+    log('Begin inventory sync.')
+    loader = Preload('api')
+    for folder in ('files', 'images'):
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+
+    if download:
+        from feeds import FeedCache, INVENTORY_FILES
+
+        files = {supplier: names for supplier, names in INVENTORY_FILES.items()
+                 if supplier == 'alpha' or not alpha_only}
+        FeedCache('files', log if verbose else None).download_all(files)
+
+    # The feeds are cached now, so the pass parses them from disk.
+    api = loader.module().API(download=False, debug=verbose)
+    if plan_folder:
+        if not os.path.exists(plan_folder):
+            os.mkdir(plan_folder)
+        api.update_inventory(alpha_only, plan_path=os.path.join(plan_folder, 'inventory.json'))
+    else:
+        api.update_inventory(alpha_only)
+    log('Finished inventory sync.')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    main()
@@ -0,0 +1,50 @@
+import gzip
+
+import pytest
+
+import backup
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().bulkthreads
+    db.products.insert_one({str(pid): {str(pid * 10 + v): {'alpha': f'A{pid}{v}'} for v in range(3)}
+                            for pid in range(25)})
+    db.inventory.insert_one({f'A{i}': {'variant_id': i, 'product_id': i // 3} for i in range(40)})
+    return db
+
+
+def test_round_trip(db, tmp_path):
+    path = str(tmp_path / 'backup.ndjson.gz')
+    assert backup.dump(db, path, batch=7) == {'products': 1, 'inventory': 1}
+    assert backup.verify(path)['end'] == {'products': 1, 'inventory': 1}
+
+    restored = mongomock.MongoClient().restored
+    assert backup.restore(restored, path, batch=7) == {'products': 1, 'inventory': 1}
+    for collection in backup.COLLECTIONS:
+        assert list(restored[collection].find()) == list(db[collection].find())
+
+    with pytest.raises(ValueError, match='not empty'):
+        backup.restore(restored, path)
+    assert backup.restore(restored, path, drop=True) == {'products': 1, 'inventory': 1}
+
+
+def test_verify_rejects_damaged_backups(db, tmp_path):
+    path = str(tmp_path / 'backup.ndjson.gz')
+    backup.dump(db, path, batch=7)
+    with gzip.open(path, 'rb') as f:
+        lines = f.readlines()
+
+    truncated = str(tmp_path / 'truncated.ndjson.gz')
+    with gzip.open(truncated, 'wb') as f:
+        f.writelines(lines[:-1])
+    with pytest.raises(ValueError, match='truncated'):
+        backup.verify(truncated)
+
+    altered = str(tmp_path / 'altered.ndjson.gz')
+    with gzip.open(altered, 'wb') as f:
+        f.writelines(lines[:1] + [lines[1].replace(b'alpha', b'sanmar')] + lines[2:])
+    with pytest.raises(ValueError, match='checksum'):
+        backup.verify(altered)
@@ -0,0 +1,126 @@
+import os
+import threading
+
+import pytest
+
+from feeds import FeedCache, QuantityIndex, StreamParser
+
+FEED = b'Item Number,Total Inventory,DROP SHIP\nA1,10,2\nA2,5,0\nA1,99,0\nA3,junk,\n'
+
+
+class Rows(StreamParser):
+    def __init__(self, columns, **kwargs):
+        self.rows = []
+        super().__init__(columns, **kwargs)
+
+    def row(self, row):
+        self.rows.append(row)
+
+
+def test_stream_parser_keeps_requested_columns_across_chunks():
+    parser = Rows(['b', 'a'])
+    data = 'a,b,c\n1,"two\nlines",3\n4,5,6'.encode()
+    for i in range(0, len(data), 3):
+        parser.feed(data[i:i + 3])
+    parser.close()
+    assert parser.rows == [{'b': 'two\nlines', 'a': '1'}, {'b': '5', 'a': '4'}]
+
+
+def test_stream_parser_reports_missing_columns():
+    parser = Rows(['a', 'x'])
+    with pytest.raises(ValueError, match='x'):
+        parser.feed(b'a,b\n')
+
+
+def test_quantity_index():
+    index = QuantityIndex('Item Number', 'Total Inventory', 'DROP SHIP')
+    index.feed(FEED)
+    index.close()
+    assert index.quantities == {'A1': 8, 'A2': 5, 'A3': 0}
+
+    kept = QuantityIndex('Item Number', 'Total Inventory', keep={'A2'})
+    kept.feed(FEED)
+    kept.close()
+    assert kept.quantities == {'A2': 5}
+
+
+@pytest.fixture
+def ftp_server(tmp_path, monkeypatch):
+    """Serve tmp_path/remote over FTP on localhost as the AlphaBroder server. Yield (<Folder>, <Commands seen>)."""
+    pytest.importorskip('pyftpdlib')
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+
+    remote = tmp_path / 'remote'
+    remote.mkdir()
+    commands = []
+
+    class Handler(FTPHandler):
+        def pre_process_command(self, line, cmd, arg):
+            commands.append((cmd, arg))
+            return super().pre_process_command(line, cmd, arg)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('user', 'secret', str(remote), perm='elr')
+    Handler.authorizer = authorizer
+    server = FTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1}, daemon=True)
+    thread.start()
+    monkeypatch.setenv('FTP_DOMAIN_ALPHA', '127.0.0.1')
+    monkeypatch.setenv('FTP_PORT_ALPHA', str(server.address[1]))
+    monkeypatch.setenv('FTP_USERNAME_ALPHA', 'user')
+    monkeypatch.setenv('FTP_PASSWORD_ALPHA', 'secret')
+    monkeypatch.setenv('FTP_TLS_ALPHA', '0')
+    yield remote, commands
+    server.close_all()
+    thread.join()
+
+
+def retrieved(commands):
+    return [(cmd, arg) for cmd, arg in commands if cmd in ('RETR', 'REST')]
+
+
+def test_download_skips_unchanged_files(tmp_path, ftp_server):
+    remote, commands = ftp_server
+    (remote / 'feed.txt').write_bytes(FEED)
+    cache = FeedCache(str(tmp_path / 'files'))
+    index = QuantityIndex('Item Number', 'Total Inventory', 'DROP SHIP')
+
+    assert cache.download('alpha', ['feed.txt'], {'feed.txt': index}) == {'feed.txt': True}
+    assert (tmp_path / 'files' / 'feed.txt').read_bytes() == FEED
+    assert index.quantities == {'A1': 8, 'A2': 5, 'A3': 0}
+    assert retrieved(commands) == [('RETR', 'feed.txt')]
+
+    # A new cache instance reads the metadata persisted by the first one.
+    commands.clear()
+    cache = FeedCache(str(tmp_path / 'files'))
+    assert cache.download('alpha', ['feed.txt']) == {'feed.txt': False}
+    assert cache.changed('alpha', ['feed.txt']) == []
+    assert retrieved(commands) == []
+
+    (remote / 'feed.txt').write_bytes(FEED + b'A4,1,0\n')
+    os.utime(remote / 'feed.txt', (1_900_000_000, 1_900_000_000))
+    assert cache.changed('alpha', ['feed.txt']) == ['feed.txt']
+    assert cache.download('alpha', ['feed.txt']) == {'feed.txt': True}
+    assert (tmp_path / 'files' / 'feed.txt').read_bytes().endswith(b'A4,1,0\n')
+
+
+def test_download_resumes_partial_transfer(tmp_path, ftp_server):
+    remote, commands = ftp_server
+    (remote / 'feed.txt').write_bytes(FEED)
+    cache = FeedCache(str(tmp_path / 'files'))
+    ftp = cache.connect('alpha')
+    stat = cache.stat(ftp, 'feed.txt')
+    ftp.quit()
+
+    # State left behind by a transfer interrupted after 20 bytes.
+    (tmp_path / 'files' / 'feed.txt.part').write_bytes(FEED[:20])
+    cache._set_meta('feed.txt', dict(stat, complete=False))
+    index = QuantityIndex('Item Number', 'Total Inventory', 'DROP SHIP')
+
+    assert cache.download('alpha', ['feed.txt'], {'feed.txt': index}) == {'feed.txt': True}
+    assert ('REST', '20') in commands
+    assert (tmp_path / 'files' / 'feed.txt').read_bytes() == FEED
+    assert not (tmp_path / 'files' / 'feed.txt.part').exists()
+    assert index.quantities == {'A1': 8, 'A2': 5, 'A3': 0}
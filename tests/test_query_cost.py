@@ -0,0 +1,52 @@
+import query_cost
+from api import API
+
+VARIANTS_PAGE = '''
+    {
+      productVariants(first: 250, query: "A1000") {
+        edges {
+          cursor
+          node {
+            legacyResourceId
+            product {
+              legacyResourceId
+            }
+            inventoryQuantity
+            inventoryItem {
+              id
+            }
+          }
+        }
+      }
+    }
+'''
+
+
+def test_estimate():
+    # The cost Shopify reported for this query when it was throttled.
+    assert query_cost.estimate(VARIANTS_PAGE) == 752
+    assert query_cost.estimate(API.levels_query(['1', '2', '3'])) == 1 + 3 * 2
+    assert query_cost.estimate(API.products_query('A1000', 50)) == 2 + 50
+    assert query_cost.estimate('mutation { productUpdate(input: {id: "1"}) { product { id } } }') == 10
+
+
+def test_pack_fills_batches_with_variants():
+    groups = [('p1', {'v1': 1, 'v2': 2}), ('p2', {'v3': 3, 'v4': 4, 'v5': 5, 'v6': 6, 'v7': 7})]
+    assert list(query_cost.pack(groups, 3)) == [
+        [('p1', {'v1': 1, 'v2': 2}), ('p2', {'v3': 3})],
+        [('p2', {'v4': 4, 'v5': 5, 'v6': 6})],
+        [('p2', {'v7': 7})]
+    ]
+
+
+def test_pack_splits_products_larger_than_a_batch():
+    product = {str(i): i for i in range(600)}
+    batches = list(query_cost.pack([('p1', product)], query_cost.MAX_IDS))
+    assert [len(batch[0][1]) for batch in batches] == [250, 250, 100]
+
+
+def test_levels_per_query_is_capped_at_max_ids(monkeypatch):
+    monkeypatch.setenv('GRAPHQL_COST_CEILING', '1000')
+    assert API(False).levels_per_query == query_cost.MAX_IDS
+    monkeypatch.setenv('GRAPHQL_COST_CEILING', '101')
+    assert API(False).levels_per_query == 50
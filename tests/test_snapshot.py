@@ -0,0 +1,26 @@
+from snapshot import Snapshot
+
+
+def test_diff_and_save(tmp_path):
+    snapshot = Snapshot('products-alpha', str(tmp_path))
+    items = {'A1': ['S1', 'a'], 'A2': ['S1', 'b'], 'B1': ['S2', 'c']}
+    assert snapshot.diff(items) == {'new': ['A1', 'A2', 'B1'], 'changed': [], 'removed': [], 'styles': {'S1', 'S2'}}
+
+    snapshot.save(items)
+    assert snapshot.diff(items) == {'new': [], 'changed': [], 'removed': [], 'styles': set()}
+
+    current = {'A1': ['S1', 'x'], 'B1': ['S3', 'c'], 'C1': ['S4', 'd']}
+    assert snapshot.diff(current) == {'new': ['C1'], 'changed': ['A1', 'B1'], 'removed': ['A2'],
+                                      'styles': {'S1', 'S2', 'S3', 'S4'}}
+
+
+def test_save_keeps_items_left_out_of_an_import(tmp_path):
+    snapshot = Snapshot('products-alpha', str(tmp_path))
+    snapshot.save({'A1': ['S1', 'a'], 'A2': ['S1', 'b']})
+
+    # Only A1 was imported this time, and A2 was removed from the feed.
+    snapshot.save({'A1': ['S1', 'x']}, removed=['A2'])
+    assert snapshot.load() == {'A1': ['S1', 'x']}
+
+    snapshot.save({'B1': ['S2', 'c']})
+    assert snapshot.diff({'A1': ['S1', 'x'], 'B1': ['S2', 'c'], 'C1': ['S3', 'd']})['new'] == ['C1']